@@ -0,0 +1,108 @@
+import threading
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future
+from functools import partial
+
+# ——— AGENDADOR JUSTO ENTRE USUÁRIOS ———
+# Uma fila por usuário dentro de cada prioridade (0 = uploads pequenos, 1 = lotes).
+# Os workers sempre olham a prioridade 0 primeiro e, dentro dela, atendem os usuários em
+# rodízio: cada usuário despacha até `peso` tarefas seguidas e vai para o fim da vez.
+# Havendo outro usuário esperando, ninguém passa de `max_por_usuario` tarefas rodando ao mesmo
+# tempo; sozinho na fila, um usuário pode ocupar todas as vagas.
+# Uma tarefa que devolve um Future (ex.: repassou o trabalho para outro Agendador) libera a vaga
+# na hora; o futuro da tarefa passa a acompanhar o devolvido.
+PRIORIDADE_ALTA = 0
+PRIORIDADE_NORMAL = 1
+
+
+def _repassar(futuro: Future, origem: Future):
+    try:
+        futuro.set_result(origem.result())
+    except BaseException as e:
+        futuro.set_exception(e)
+
+
+class Agendador:
+    def __init__(self, max_simultaneos: int = 4, max_por_usuario: int = 2, pesos: dict = None):
+        self.max_simultaneos = max_simultaneos
+        self.max_por_usuario = max_por_usuario
+        self.pesos = pesos or {}
+        self._cond = threading.Condition()
+        self._filas = {PRIORIDADE_ALTA: OrderedDict(), PRIORIDADE_NORMAL: OrderedDict()}
+        self._creditos = {}
+        self._rodando = Counter()
+        self._workers = []
+
+    def _iniciar_workers(self):
+        # Chamado com o lock; os workers só sobem no primeiro uso
+        while len(self._workers) < self.max_simultaneos:
+            worker = threading.Thread(target=self._trabalhar, name=f"agendador-{len(self._workers)}", daemon=True)
+            self._workers.append(worker)
+            worker.start()
+
+    def submeter(self, usuario: str, fn, *args, prioridade: int = PRIORIDADE_NORMAL, **kwargs) -> Future:
+        futuro = Future()
+        with self._cond:
+            self._iniciar_workers()
+            self._filas[prioridade].setdefault(usuario, deque()).append((futuro, fn, args, kwargs))
+            self._cond.notify()
+        return futuro
+
+    def _proxima(self):
+        na_fila = {u for filas in self._filas.values() for u in filas}
+        for prioridade, filas in self._filas.items():
+            for usuario in list(filas):
+                if self._rodando[usuario] >= self.max_por_usuario and na_fila - {usuario}:
+                    continue
+                fila = filas[usuario]
+                tarefa = fila.popleft()
+                chave = (prioridade, usuario)
+                creditos = self._creditos.pop(chave, self.pesos.get(usuario, 1)) - 1
+                if not fila:
+                    del filas[usuario]
+                elif creditos <= 0:
+                    filas.move_to_end(usuario)
+                else:
+                    self._creditos[chave] = creditos
+                return usuario, tarefa
+        return None
+
+    def _trabalhar(self):
+        while True:
+            with self._cond:
+                item = self._proxima()
+                while item is None:
+                    self._cond.wait()
+                    item = self._proxima()
+                usuario, (futuro, fn, args, kwargs) = item
+                self._rodando[usuario] += 1
+
+            try:
+                if futuro.set_running_or_notify_cancel():
+                    try:
+                        resultado = fn(*args, **kwargs)
+                    except BaseException as e:
+                        futuro.set_exception(e)
+                    else:
+                        if isinstance(resultado, Future):
+                            resultado.add_done_callback(partial(_repassar, futuro))
+                        else:
+                            futuro.set_result(resultado)
+            finally:
+                with self._cond:
+                    self._rodando[usuario] -= 1
+                    if not self._rodando[usuario]:
+                        del self._rodando[usuario]
+                    self._cond.notify_all()
+
+    def situacao(self) -> dict:
+        with self._cond:
+            return {
+                "max_simultaneos": self.max_simultaneos,
+                "max_por_usuario": self.max_por_usuario,
+                "rodando": dict(self._rodando),
+                "na_fila": {
+                    "pequenos" if p == PRIORIDADE_ALTA else "lotes": {u: len(f) for u, f in filas.items()}
+                    for p, filas in self._filas.items()
+                },
+            }
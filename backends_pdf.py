@@ -0,0 +1,311 @@
+import ctypes
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from cache_fontes import abrir_pdfplumber
+from cache_paginas import DocumentoCache, EXTENSAO_CACHE, RecorteCache
+from pdfplumber.utils import extract_text, extract_words, within_bbox
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:  # backend opcional
+    pdfium = None
+
+try:
+    import pytesseract
+except ImportError:  # necessário só para o backend "ocr"
+    pytesseract = None
+
+# ——— BACKENDS DE LEITURA DE PDF ———
+# "pdfplumber": pipeline completo do pdfminer (padrão).
+# "pdfium":     consultas de retângulo direto no text-page do PDFium, bem mais leve.
+# "ocr":        contas escaneadas; cada retângulo pedido é rasterizado sozinho e lido pelo Tesseract.
+# Ambos expõem o mesmo pedaço da API de página usado pelos parsers:
+#   pdf.pages, page.extract_text(), page.extract_words(), page.within_bbox(bbox).extract_text()
+BACKENDS = ("pdfplumber", "pdfium")
+
+# ——— CONFIGURAÇÃO DO OCR ———
+OCR_IDIOMA = "por"
+OCR_DPI = 300
+OCR_CONFIG = "--psm 7"          # cada recorte é uma linha de texto
+OCR_CACHE_DIR = None            # pasta para persistir o cache de OCR entre execuções
+MAX_CACHE_OCR_PAGINAS = 500
+
+# O PDFium não é thread-safe, nem entre documentos diferentes: toda chamada passa por este lock.
+# DocumentoPdfium o mantém do open ao close, então threads que abrem PDFs com o PDFium no mesmo
+# processo (requisições Flask, workers do agendador) se revezam; os processos do pool não disputam.
+_pdfium_lock = threading.RLock()
+
+
+class PaginaPdfium:
+    def __init__(self, page, doctop: float = 0.0):
+        self.page = page
+        self.width, self.height = page.get_size()
+        self.doctop = doctop
+        self._textpage = None
+        self._chars = None
+
+    @property
+    def textpage(self):
+        if self._textpage is None:
+            self._textpage = self.page.get_textpage()
+        return self._textpage
+
+    @property
+    def chars(self) -> list:
+        """
+        Caracteres do text-page no formato do pdfplumber (text, x0, x1, top, bottom, doctop, upright).
+        A caixa segue o pdfminer: largura do avanço e altura do corpo da fonte a partir da descendente,
+        para que within_bbox mantenha exatamente os mesmos caracteres que o pdfplumber.
+        """
+        if self._chars is None:
+            tp = self.textpage
+            x, y = ctypes.c_double(), ctypes.c_double()
+            descendente = ctypes.c_float()
+            chars = []
+            for i in range(tp.count_chars()):
+                if pdfium.raw.FPDFText_IsGenerated(tp.raw, i) == 1:
+                    continue  # espaços e quebras inseridos pelo PDFium, não existem no PDF
+                texto = tp.get_text_range(i, 1)
+                obj = pdfium.raw.FPDFText_GetTextObject(tp.raw, i)
+                if not texto or texto in "\r\n\x02" or not obj:
+                    continue
+                tamanho = pdfium.raw.FPDFText_GetFontSize(tp.raw, i)
+                pdfium.raw.FPDFText_GetCharOrigin(tp.raw, i, x, y)
+                pdfium.raw.FPDFFont_GetDescent(pdfium.raw.FPDFTextObj_GetFont(obj), ctypes.c_float(tamanho), descendente)
+                left, _, right, _ = tp.get_charbox(i, loose=True)
+                bottom = self.height - (y.value + descendente.value)
+                chars.append({
+                    "text": texto,
+                    "x0": left,
+                    "x1": right,
+                    "top": bottom - tamanho,
+                    "bottom": bottom,
+                    "doctop": self.doctop + bottom - tamanho,
+                    "upright": pdfium.raw.FPDFText_GetCharAngle(tp.raw, i) == 0,
+                })
+            self._chars = chars
+        return self._chars
+
+    def extract_text(self) -> str:
+        # Mesma montagem de linhas do pdfplumber sobre os chars (get_text_range segue a ordem do
+        # content stream, o que mudaria os campos tirados por regex do texto da página)
+        return extract_text(self.chars)
+
+    def within_bbox(self, bbox) -> RecorteCache:
+        # Só caracteres inteiramente dentro do retângulo, como o within_bbox do pdfplumber
+        # (get_text_bounded traria também os que só encostam na borda)
+        return RecorteCache(within_bbox(self.chars, bbox))
+
+    def extract_words(self) -> list:
+        # Mesmo agrupamento do pdfplumber, para o deslocamento de multa/juros/correção não mudar de backend
+        return extract_words(self.chars)
+
+    def close(self):
+        if self._textpage is not None:
+            self._textpage.close()
+        self.page.close()
+
+
+class DocumentoPdfium:
+    def __init__(self, pdf_path: str):
+        _pdfium_lock.acquire()
+        self._aberto = True
+        try:
+            self.doc = pdfium.PdfDocument(pdf_path)
+            self.pages = self._carregar_paginas(pdf_path)
+        except BaseException:
+            self._aberto = False
+            _pdfium_lock.release()
+            raise
+
+    def _carregar_paginas(self, pdf_path: str) -> list:
+        paginas = []
+        doctop = 0.0
+        for i in range(len(self.doc)):
+            paginas.append(PaginaPdfium(self.doc[i], doctop))
+            doctop += paginas[-1].height
+        return paginas
+
+    def close(self):
+        if not self._aberto:
+            return
+        try:
+            for p in self.pages:
+                p.close()
+            self.doc.close()
+        finally:
+            self._aberto = False
+            _pdfium_lock.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# ——— BACKEND OCR (SÓ OS RETÂNGULOS DO LAYOUT) ———
+_cache_ocr = OrderedDict()      # hash da página → {bbox: texto}
+_cache_ocr_lock = threading.Lock()
+
+
+def _hash_pagina(page, pdf_path: str, indice: int) -> str:
+    """Hash do conteúdo da página: bytes crus das imagens (o scan), ou arquivo + índice como reserva."""
+    h = hashlib.sha256()
+    for obj in page.get_objects():
+        if obj.type == pdfium.raw.FPDF_PAGEOBJ_IMAGE:
+            h.update(obj.get_data(decode_simple=False))
+    if h.digest() == hashlib.sha256().digest():
+        with open(pdf_path, "rb") as f:
+            h.update(f.read())
+        h.update(str(indice).encode())
+    return h.hexdigest()
+
+
+def _textos_ocr_da_pagina(hash_pagina: str) -> dict:
+    with _cache_ocr_lock:
+        textos = _cache_ocr.get(hash_pagina)
+        if textos is not None:
+            _cache_ocr.move_to_end(hash_pagina)
+            return textos
+    textos = {}
+    if OCR_CACHE_DIR:
+        caminho = os.path.join(OCR_CACHE_DIR, hash_pagina + ".json")
+        if os.path.exists(caminho):
+            with open(caminho, encoding="utf-8") as f:
+                textos = json.load(f)
+    with _cache_ocr_lock:
+        _cache_ocr[hash_pagina] = textos
+        while len(_cache_ocr) > MAX_CACHE_OCR_PAGINAS:
+            _cache_ocr.popitem(last=False)
+    return textos
+
+
+def _persistir_ocr(hash_pagina: str, textos: dict):
+    if not OCR_CACHE_DIR:
+        return
+    os.makedirs(OCR_CACHE_DIR, exist_ok=True)
+    caminho = os.path.join(OCR_CACHE_DIR, hash_pagina + ".json")
+    with open(caminho + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(textos, f, ensure_ascii=False)
+    os.replace(caminho + ".tmp", caminho)
+
+
+class RecorteOcr:
+    def __init__(self, pagina, bbox):
+        self.pagina = pagina
+        self.bbox = bbox
+
+    def extract_text(self) -> str:
+        pagina = self.pagina
+        chave = ",".join(f"{v:.2f}" for v in self.bbox) + f"@{OCR_DPI}"
+        textos = _textos_ocr_da_pagina(pagina.hash)
+        if chave in textos:
+            return textos[chave]
+
+        x0, top, x1, bottom = self.bbox
+        # crop = quanto cortar de cada lado (esquerda, baixo, direita, cima), em pontos
+        corte = (max(0, x0), max(0, pagina.height - bottom), max(0, pagina.width - x1), max(0, top))
+        imagem = pagina.page.render(scale=OCR_DPI / 72, crop=corte).to_pil()
+        texto = pytesseract.image_to_string(imagem, lang=OCR_IDIOMA, config=OCR_CONFIG).strip()
+
+        textos[chave] = texto
+        _persistir_ocr(pagina.hash, textos)
+        return texto
+
+
+class PaginaOcr:
+    """
+    Página escaneada: não há texto corrido (extract_text/extract_words vazios), só os
+    retângulos pedidos via within_bbox são lidos.
+    """
+    def __init__(self, page, pdf_path: str, indice: int):
+        self.page = page
+        self.width, self.height = page.get_size()
+        self.hash = _hash_pagina(page, pdf_path, indice)
+
+    def extract_text(self) -> str:
+        return ""
+
+    def extract_words(self) -> list:
+        return []
+
+    def within_bbox(self, bbox) -> RecorteOcr:
+        return RecorteOcr(self, bbox)
+
+    def close(self):
+        self.page.close()
+
+
+class DocumentoOcr(DocumentoPdfium):
+    def _carregar_paginas(self, pdf_path: str) -> list:
+        return [PaginaOcr(self.doc[i], pdf_path, i) for i in range(len(self.doc))]
+
+
+def primeira_pagina_sem_texto(pdf_path: str) -> bool:
+    """True para PDFs escaneados (a primeira página não tem camada de texto)."""
+    if pdf_path.endswith(EXTENSAO_CACHE):
+        return False
+    backend = "pdfium" if pdfium is not None else "pdfplumber"
+    with abrir_pdf(pdf_path, backend) as pdf:
+        return not pdf.pages or not (pdf.pages[0].extract_text() or "").strip()
+
+
+def abrir_pdf(pdf_path: str, backend: str = "pdfplumber"):
+    """
+    Abre o PDF com o backend pedido; o retorno é usado com `with` como o pdfplumber.open.
+    Entradas do cache de páginas (*.pags) são abertas direto do cache, qualquer que seja o backend.
+    """
+    if pdf_path.endswith(EXTENSAO_CACHE):
+        return DocumentoCache(pdf_path)
+    if backend == "pdfplumber":
+        return abrir_pdfplumber(pdf_path)
+    if backend == "pdfium":
+        if pdfium is None:
+            raise RuntimeError("Backend 'pdfium' requer o pacote pypdfium2 (pip install pypdfium2).")
+        return DocumentoPdfium(pdf_path)
+    if backend == "ocr":
+        if pdfium is None or pytesseract is None:
+            raise RuntimeError("Backend 'ocr' requer pypdfium2 e pytesseract (e o Tesseract instalado).")
+        return DocumentoOcr(pdf_path)
+    raise ValueError(f"Backend de PDF desconhecido: '{backend}'. Use um de {BACKENDS + ('ocr',)}.")
+
+
+# ——— PDFs CONSOLIDADOS (VÁRIAS CONTAS NO MESMO ARQUIVO) ———
+def dividir_pdf(pdf_path: str, agrupar) -> list:
+    """
+    Separa um PDF consolidado abrindo o original uma única vez. `agrupar(textos)` recebe o texto
+    de cada página e devolve [(instalacao, [índices base 0])]; havendo mais de um grupo, cada um
+    é gravado em <base>__NNN_<instalacao>.pdf ao lado do original.
+    Retorna [(instalacao, caminho, índices)]; PDFs com uma única conta voltam inalterados.
+    """
+    if pdfium is None:
+        with abrir_pdf(pdf_path) as pdf:
+            grupos = agrupar([p.extract_text() or "" for p in pdf.pages]) if len(pdf.pages) > 1 else [("", [0])]
+        if len(grupos) > 1:
+            raise RuntimeError("Separar PDFs consolidados requer o pacote pypdfium2 (pip install pypdfium2).")
+        return [(grupos[0][0], pdf_path, grupos[0][1])]
+
+    with DocumentoPdfium(pdf_path) as origem:
+        if len(origem.pages) == 1:
+            return [("", pdf_path, [0])]
+        grupos = agrupar([p.extract_text() for p in origem.pages])
+        if len(grupos) == 1:
+            return [(grupos[0][0], pdf_path, grupos[0][1])]
+
+        base, _ = os.path.splitext(pdf_path)
+        partes = []
+        for n, (instalacao, indices) in enumerate(grupos, start=1):
+            destino = f"{base}__{n:03d}_{instalacao or 'sem-instalacao'}.pdf"
+            novo = pdfium.PdfDocument.new()
+            try:
+                novo.import_pages(origem.doc, indices)
+                novo.save(destino)
+            finally:
+                novo.close()
+            partes.append((instalacao, destino, indices))
+        return partes
@@ -0,0 +1,175 @@
+import hashlib
+import os
+import pickle
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import pdfplumber
+from pdfminer.pdfinterp import PDFResourceManager
+from pdfminer.pdftypes import PDFObjRef, PDFStream
+from pdfminer.psparser import PSLiteral
+
+# ——— CACHE DE FONTES ENTRE DOCUMENTOS ———
+# O pdfminer só reaproveita fontes dentro do mesmo PDF (por objid). Como toda conta da mesma
+# concessionária embute as mesmas fontes, aqui a fonte já decodificada (programa, larguras,
+# ToUnicode/CMap) é guardada pelo digest do seu dicionário + streams e reaproveitada por
+# qualquer documento aberto no mesmo processo. FONTES_CACHE_DIR também persiste em disco.
+MAX_FONTES_CACHE = 256
+FONTES_CACHE_DIR = None
+
+_fontes = OrderedDict()
+_fontes_lock = threading.Lock()
+estatisticas = {"acertos": 0, "faltas": 0}
+
+
+def _atualizar_digest(h, obj, visitados, profundidade=0):
+    if profundidade > 12:
+        h.update(b"<fundo>")
+        return
+    if isinstance(obj, PDFObjRef):
+        chave = (id(obj.doc), obj.objid)
+        if chave in visitados:
+            h.update(b"<ciclo>")
+            return
+        visitados.add(chave)
+        obj = obj.resolve()
+    if isinstance(obj, PDFStream):
+        h.update(b"S")
+        _atualizar_digest(h, obj.attrs, visitados, profundidade + 1)
+        dados = obj.rawdata if obj.rawdata is not None else obj.data
+        h.update(hashlib.sha1(dados or b"").digest())
+    elif isinstance(obj, dict):
+        h.update(b"D")
+        for k in sorted(obj, key=str):
+            h.update(str(k).encode("utf-8", "replace"))
+            _atualizar_digest(h, obj[k], visitados, profundidade + 1)
+    elif isinstance(obj, (list, tuple)):
+        h.update(b"L%d" % len(obj))
+        for item in obj:
+            _atualizar_digest(h, item, visitados, profundidade + 1)
+    elif isinstance(obj, PSLiteral):
+        h.update(b"/" + str(obj.name).encode("utf-8", "replace"))
+    elif isinstance(obj, bytes):
+        h.update(b"B" + obj)
+    else:
+        h.update(repr(obj).encode("utf-8", "replace"))
+
+
+def digest_fonte(spec) -> str:
+    h = hashlib.sha256()
+    _atualizar_digest(h, spec, set())
+    return h.hexdigest()
+
+
+def _ler_fonte(digest: str):
+    with _fontes_lock:
+        fonte = _fontes.get(digest)
+        if fonte is not None:
+            _fontes.move_to_end(digest)
+            return fonte
+    if FONTES_CACHE_DIR:
+        caminho = os.path.join(FONTES_CACHE_DIR, digest + ".fonte")
+        if os.path.exists(caminho):
+            try:
+                with open(caminho, "rb") as f:
+                    fonte = pickle.load(f)
+            except Exception:
+                return None
+            _guardar_fonte(digest, fonte, persistir=False)
+            return fonte
+    return None
+
+
+def _guardar_fonte(digest: str, fonte, persistir: bool = True):
+    with _fontes_lock:
+        _fontes[digest] = fonte
+        _fontes.move_to_end(digest)
+        while len(_fontes) > MAX_FONTES_CACHE:
+            _fontes.popitem(last=False)
+    if persistir and FONTES_CACHE_DIR:
+        os.makedirs(FONTES_CACHE_DIR, exist_ok=True)
+        caminho = os.path.join(FONTES_CACHE_DIR, digest + ".fonte")
+        try:
+            with open(caminho + ".tmp", "wb") as f:
+                pickle.dump(fonte, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(caminho + ".tmp", caminho)
+        except Exception as e:  # algumas fontes guardam objetos que não serializam
+            print(f"[DEBUG] fonte {digest[:12]} não persistida: {e}")
+            if os.path.exists(caminho + ".tmp"):
+                os.remove(caminho + ".tmp")
+
+
+def _desanexar_do_documento(fonte):
+    # descriptor e fontfile só são lidos no __init__ das fontes do pdfminer, mas guardam
+    # PDFObjRefs que prenderiam o documento de origem (e seu arquivo) enquanto a fonte
+    # estiver no cache.
+    if hasattr(fonte, "descriptor"):
+        fonte.descriptor = {}
+    if hasattr(fonte, "fontfile"):
+        fonte.fontfile = None
+    return fonte
+
+
+class GerenciadorRecursosCompartilhado(PDFResourceManager):
+    def get_font(self, objid, spec):
+        if objid and objid in self._cached_fonts:
+            return self._cached_fonts[objid]
+        try:
+            digest = digest_fonte(spec)
+        except Exception:
+            return super().get_font(objid, spec)
+
+        fonte = _ler_fonte(digest)
+        if fonte is None:
+            estatisticas["faltas"] += 1
+            fonte = _desanexar_do_documento(super().get_font(None, spec))
+            _guardar_fonte(digest, fonte)
+        else:
+            estatisticas["acertos"] += 1
+        if objid:
+            self._cached_fonts[objid] = fonte
+        return fonte
+
+
+def abrir_pdfplumber(pdf_path: str, compartilhar_fontes: bool = True):
+    """pdfplumber.open com o gerenciador de recursos que reaproveita fontes entre documentos."""
+    pdf = pdfplumber.open(pdf_path)
+    if compartilhar_fontes:
+        pdf.rsrcmgr = GerenciadorRecursosCompartilhado()
+    return pdf
+
+
+def limpar_cache():
+    with _fontes_lock:
+        _fontes.clear()
+    estatisticas.update(acertos=0, faltas=0)
+
+
+# ——— BENCHMARK ———
+def medir(caminhos: list, compartilhar_fontes: bool) -> float:
+    """Tempo médio por conta (s) para extrair texto e palavras de todas as páginas."""
+    inicio = time.perf_counter()
+    for caminho in caminhos:
+        with abrir_pdfplumber(caminho, compartilhar_fontes) as pdf:
+            for page in pdf.pages:
+                page.extract_text()
+                page.extract_words()
+    return (time.perf_counter() - inicio) / len(caminhos)
+
+
+if __name__ == "__main__":
+    # python cache_fontes.py contas_cemig/*.pdf
+    arquivos = sys.argv[1:]
+    if not arquivos:
+        sys.exit("uso: python cache_fontes.py <pdfs da mesma concessionária>")
+    medir(arquivos[:1], False)  # aquece imports e caches do próprio pdfminer
+    sem_cache = medir(arquivos, False)
+    limpar_cache()
+    com_cache = medir(arquivos, True)
+    print(f"[BENCH] {len(arquivos)} conta(s)")
+    print(f"[BENCH] sem cache de fontes: {sem_cache * 1000:.1f} ms/conta")
+    print(f"[BENCH] com cache de fontes: {com_cache * 1000:.1f} ms/conta "
+          f"({(1 - com_cache / sem_cache) * 100:.1f}% menos; acertos={estatisticas['acertos']}, "
+          f"faltas={estatisticas['faltas']})")
@@ -0,0 +1,141 @@
+import hashlib
+import os
+import pickle
+import zlib
+from array import array
+
+from cache_fontes import abrir_pdfplumber
+from pdfplumber.utils import extract_text, extract_words, within_bbox
+
+# ——— CACHE DE PÁGINAS EXTRAÍDAS ———
+# Cada conta processada pode ter sua tabela de caracteres guardada em <pasta>/<sha256>.pags
+# (pickle + zlib, coordenadas em colunas array('d')). Com isso dá para reextrair campos
+# depois de mudar COORDENADAS_* sem reabrir os PDFs originais.
+EXTENSAO_CACHE = ".pags"
+COLUNAS_CHAR = ("x0", "x1", "top", "bottom", "doctop")
+
+
+def hash_conteudo(pdf_path: str) -> str:
+    h = hashlib.sha256()
+    with open(pdf_path, "rb") as f:
+        for bloco in iter(lambda: f.read(1 << 16), b""):
+            h.update(bloco)
+    return h.hexdigest()
+
+
+def caminho_cache(pasta: str, chave: str) -> str:
+    return os.path.join(pasta, chave + EXTENSAO_CACHE)
+
+
+def _compactar_pagina(page) -> dict:
+    chars = page.chars
+    return {
+        "width": page.width,
+        "height": page.height,
+        "texto": page.extract_text() or "",
+        "chars": "".join(c["text"] for c in chars),
+        "tamanhos": array("H", (len(c["text"]) for c in chars)).tobytes(),
+        "upright": bytes(bool(c["upright"]) for c in chars),
+        **{col: array("d", (c[col] for c in chars)).tobytes() for col in COLUNAS_CHAR},
+    }
+
+
+def compactar_paginas(pages) -> list:
+    """Páginas já abertas (pdfplumber ou pdfium) no formato guardado no cache."""
+    return [_compactar_pagina(p) for p in pages]
+
+
+def gravar_cache(pdf_path: str, pasta: str, meta: dict, paginas: list = None) -> str:
+    """
+    Grava as páginas de `pdf_path` no cache e devolve a chave (hash do conteúdo).
+    `paginas` vem de compactar_paginas sobre o documento que o parser já abriu; sem ele o PDF é reaberto.
+    """
+    os.makedirs(pasta, exist_ok=True)
+    chave = hash_conteudo(pdf_path)
+    if paginas is None:
+        with abrir_pdfplumber(pdf_path) as pdf:
+            paginas = compactar_paginas(pdf.pages)
+    salvar_entrada(caminho_cache(pasta, chave), {"meta": meta, "paginas": paginas})
+    return chave
+
+
+def salvar_entrada(caminho: str, entrada: dict):
+    temporario = caminho + ".tmp"
+    with open(temporario, "wb") as f:
+        f.write(zlib.compress(pickle.dumps(entrada, protocol=pickle.HIGHEST_PROTOCOL)))
+    os.replace(temporario, caminho)
+
+
+def ler_entrada(caminho: str) -> dict:
+    with open(caminho, "rb") as f:
+        return pickle.loads(zlib.decompress(f.read()))
+
+
+def listar_cache(pasta: str) -> list:
+    if not os.path.isdir(pasta):
+        return []
+    return sorted(os.path.join(pasta, n) for n in os.listdir(pasta) if n.endswith(EXTENSAO_CACHE))
+
+
+# ——— PÁGINAS DO CACHE COM A MESMA API DO PDFPLUMBER ———
+class RecorteCache:
+    def __init__(self, chars):
+        self.chars = chars
+
+    def extract_text(self) -> str:
+        return extract_text(self.chars)
+
+
+class PaginaCache:
+    def __init__(self, dados: dict):
+        self.width = dados["width"]
+        self.height = dados["height"]
+        self._texto = dados["texto"]
+        self._dados = dados
+        self._chars = None
+
+    @property
+    def chars(self) -> list:
+        if self._chars is None:
+            d = self._dados
+            colunas = {}
+            for col in COLUNAS_CHAR:
+                valores = array("d")
+                valores.frombytes(d[col])
+                colunas[col] = valores
+            tamanhos = array("H")
+            tamanhos.frombytes(d["tamanhos"])
+            chars, pos = [], 0
+            for i, n in enumerate(tamanhos):
+                c = {col: colunas[col][i] for col in COLUNAS_CHAR}
+                c["text"] = d["chars"][pos:pos + n]
+                c["upright"] = bool(d["upright"][i])
+                chars.append(c)
+                pos += n
+            self._chars = chars
+        return self._chars
+
+    def extract_text(self) -> str:
+        return self._texto
+
+    def extract_words(self) -> list:
+        return extract_words(self.chars)
+
+    def within_bbox(self, bbox) -> RecorteCache:
+        return RecorteCache(within_bbox(self.chars, bbox))
+
+
+class DocumentoCache:
+    def __init__(self, caminho: str):
+        entrada = ler_entrada(caminho)
+        self.meta = entrada["meta"]
+        self.pages = [PaginaCache(p) for p in entrada["paginas"]]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,487 @@
+"""
+Teste de carga ponta a ponta dos apps Flask (importador.py, importador2.py, app.py, server.py).
+
+Sobe um servidor local que faz o papel do Google (token OAuth, Sheets v4, Apps Script e Drive)
+com latência, erros 500 e 429 configuráveis, inicia cada app num subprocesso apontado para ele
+e dispara uploads concorrentes de PDFs gerados. No fim imprime vazão, percentis de latência e
+taxa de erro por endpoint.
+
+Exemplo:
+    python carga.py --apps importador,app --requisicoes 200 --concorrencia 16 \
+        --latencia-ms 80 --taxa-429 0.02 --taxa-erro 0.01 --processos 4
+"""
+import argparse
+import importlib
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import requests
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# ——— ROTAS DE UPLOAD DE CADA APP ———
+ALVOS = {
+    "importador": {"rota": "/", "formato": "multipart"},
+    "importador2": {"rota": "/", "formato": "multipart"},
+    "app": {"rota": "/importar", "formato": "multipart"},
+    "server": {"rota": "/extract", "formato": "json"},
+}
+
+HOSTS_GOOGLE = (
+    "oauth2.googleapis.com",
+    "accounts.google.com",
+    "sheets.googleapis.com",
+    "www.googleapis.com",
+    "script.google.com",
+)
+
+# Cabeçalho da aba CONTAS servido pela planilha falsa
+HEADERS_PADRAO = [
+    "Instalação", "fatDataVcto", "fatDataEmissao", "fatValorFatura", "concCod", "fatDataCadastro",
+    "fatDataReferencia", "fatDataLeituraAtual", "NOTAFISCAL", "ENDERECO", "cadTarifaCod", "cadSubGrupoCod",
+    "fatCodigoBarras", "fatDescontoFio", "fatDescontoFioKWh", "fatMultasDiversas", "instalacao",
+]
+
+# Apenas estas rotas recebem falhas injetadas; token e metadados precisam responder para o app subir
+ROTAS_COM_FALHA = ("sheets_append", "apps_script", "drive_upload")
+
+
+# ——— SERVIDOR FALSO DO GOOGLE ———
+class EstadoFake:
+    def __init__(self, latencia_ms=0, jitter_ms=0, taxa_erro=0.0, taxa_429=0.0, headers=None):
+        self.latencia = latencia_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.taxa_erro = taxa_erro
+        self.taxa_429 = taxa_429
+        self.headers = headers or HEADERS_PADRAO
+        self.lock = threading.Lock()
+        self.contadores = defaultdict(Counter)
+        self.linhas_gravadas = 0
+
+    def registrar(self, rota, status):
+        with self.lock:
+            self.contadores[rota][str(status)] += 1
+
+
+def classificar_rota(metodo: str, caminho: str) -> str:
+    if caminho.startswith("/token") or caminho.startswith("/o/oauth2"):
+        return "token"
+    if caminho.startswith("/macros/"):
+        return "apps_script"
+    if "/drive/" in caminho:
+        return "drive_upload"
+    if caminho.startswith("/v4/spreadsheets/"):
+        if ":append" in caminho:
+            return "sheets_append"
+        if "/values" in caminho:
+            return "sheets_values_get" if metodo == "GET" else "sheets_values_update"
+        return "sheets_meta"
+    return "desconhecida"
+
+
+class ManipuladorFake(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    estado: EstadoFake = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._responder("GET")
+
+    def do_POST(self):
+        self._responder("POST")
+
+    def do_PUT(self):
+        self._responder("PUT")
+
+    def _json(self, status, corpo, extras=None):
+        dados = json.dumps(corpo).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(dados)))
+        for k, v in (extras or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(dados)
+
+    def _responder(self, metodo):
+        tamanho = int(self.headers.get("Content-Length") or 0)
+        corpo = self.rfile.read(tamanho) if tamanho else b""
+        caminho = urlsplit(self.path).path
+        estado = self.estado
+
+        if caminho == "/__stats":
+            with estado.lock:
+                self._json(200, {"rotas": estado.contadores, "linhas_gravadas": estado.linhas_gravadas})
+            return
+
+        rota = classificar_rota(metodo, caminho)
+        if estado.latencia or estado.jitter:
+            time.sleep(max(0.0, estado.latencia + random.uniform(-estado.jitter, estado.jitter)))
+
+        if rota in ROTAS_COM_FALHA:
+            sorteio = random.random()
+            if sorteio < estado.taxa_429:
+                estado.registrar(rota, 429)
+                self._json(429, {"error": {"code": 429, "status": "RESOURCE_EXHAUSTED"}}, {"Retry-After": "1"})
+                return
+            if sorteio < estado.taxa_429 + estado.taxa_erro:
+                estado.registrar(rota, 500)
+                self._json(500, {"error": {"code": 500, "status": "INTERNAL"}})
+                return
+
+        if rota == "token":
+            status, resposta = 200, {"access_token": "fake-token", "expires_in": 3600, "token_type": "Bearer"}
+        elif rota == "sheets_meta":
+            planilha = caminho.split("/")[3]
+            status, resposta = 200, {
+                "spreadsheetId": planilha,
+                "properties": {"title": "Planilha de carga", "locale": "pt_BR", "timeZone": "America/Sao_Paulo"},
+                "sheets": [{"properties": {
+                    "sheetId": 0, "title": "CONTAS", "index": 0, "sheetType": "GRID",
+                    "gridProperties": {"rowCount": 100000, "columnCount": len(estado.headers)},
+                }}],
+            }
+        elif rota == "sheets_values_get":
+            status, resposta = 200, {"range": "CONTAS!A1:ZZ1", "majorDimension": "ROWS", "values": [estado.headers]}
+        elif rota in ("sheets_append", "sheets_values_update"):
+            try:
+                linhas = len(json.loads(corpo or b"{}").get("values", []))
+            except ValueError:
+                linhas = 0
+            with estado.lock:
+                estado.linhas_gravadas += linhas
+            status, resposta = 200, {"spreadsheetId": caminho.split("/")[3], "updates": {"updatedRows": linhas}}
+        elif rota == "apps_script":
+            status, resposta = 200, {"status": "ok"}
+        elif rota == "drive_upload":
+            status, resposta = 200, {"id": f"fake-{random.getrandbits(48):012x}"}
+        else:
+            status, resposta = 404, {"error": {"code": 404, "message": caminho}}
+
+        estado.registrar(rota, status)
+        self._json(status, resposta)
+
+
+def iniciar_fake_google(estado: EstadoFake) -> tuple:
+    manipulador = type("Manipulador", (ManipuladorFake,), {"estado": estado})
+    servidor = ThreadingHTTPServer(("127.0.0.1", 0), manipulador)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor, f"http://127.0.0.1:{servidor.server_address[1]}"
+
+
+# ——— PDFs SINTÉTICOS ———
+def _texto_pdf(texto: str) -> str:
+    return texto.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def gerar_pdf_contas(instalacoes: list, altura=842, largura=595) -> bytes:
+    """Gera um PDF mínimo (Helvetica, WinAnsi) com uma página de conta B3 por instalação."""
+    objetos = []
+    paginas = []
+
+    def adicionar(conteudo: bytes) -> int:
+        objetos.append(conteudo)
+        return len(objetos)
+
+    fonte = adicionar(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>")
+    raiz_paginas = adicionar(b"")  # preenchido no fim
+
+    for instalacao in instalacoes:
+        valor = f"{random.uniform(80, 4000):.2f}".replace(".", ",")
+        # (x, topo, texto) no sistema do pdfplumber (origem no topo)
+        campos = [
+            (15.5, 90.0, "CEMIG"),
+            (143.0, 146.0, instalacao),
+            (146.0, 118.0, "10/08/2025"),
+            (356.0, 183.0, "B3"),
+            (297.0, 183.0, "B3 Convencional"),
+            (381.0, 92.0, "SUBGRUPO B3"),
+            (40.0, 60.0, f"Nº DA INSTALAÇÃO {instalacao}"),
+            (40.0, 70.0, f"NOTA FISCAL Nº {random.randint(100000, 999999)}"),
+            (354.0, 752.0, f"R$ {valor}"),
+            (40.0, 400.0, "Saldo para o próximo mês"),
+            (40.0, 800.0, " ".join(f"{random.randint(10**10, 10**11 - 1)}-{random.randint(0, 9)}" for _ in range(4))),
+        ]
+        linhas = ["BT"]
+        for x, topo, texto in campos:
+            y = altura - topo - 7 + 0.207 * 7
+            linhas.append(f"/F1 7 Tf 1 0 0 1 {x:.2f} {y:.2f} Tm ({_texto_pdf(texto)}) Tj")
+        linhas.append("ET")
+        stream = "\n".join(linhas).encode("cp1252")
+        conteudo = adicionar(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        paginas.append(adicionar(
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %d %d] /Resources << /Font << /F1 %d 0 R >> >> "
+            b"/Contents %d 0 R >>" % (raiz_paginas, largura, altura, fonte, conteudo)
+        ))
+
+    kids = " ".join(f"{p} 0 R" for p in paginas).encode()
+    objetos[raiz_paginas - 1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(paginas))
+    catalogo = adicionar(b"<< /Type /Catalog /Pages %d 0 R >>" % raiz_paginas)
+
+    saida = bytearray(b"%PDF-1.4\n")
+    posicoes = []
+    for i, obj in enumerate(objetos, start=1):
+        posicoes.append(len(saida))
+        saida += b"%d 0 obj\n" % i + obj + b"\nendobj\n"
+    inicio_xref = len(saida)
+    saida += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objetos) + 1)
+    for pos in posicoes:
+        saida += b"%010d 00000 n \n" % pos
+    saida += b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objetos) + 1, catalogo, inicio_xref)
+    return bytes(saida)
+
+
+def gerar_credencial_falsa(destino: str):
+    """Conta de serviço descartável (chave RSA nova) apontando para o token do servidor falso."""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    chave = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = chave.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ).decode("ascii")
+    with open(destino, "w") as f:
+        json.dump({
+            "type": "service_account",
+            "project_id": "carga-local",
+            "private_key_id": "carga",
+            "private_key": pem,
+            "client_email": "carga@carga-local.iam.gserviceaccount.com",
+            "client_id": "0",
+            "auth_uri": "https://accounts.google.com/o/oauth2/auth",
+            "token_uri": "https://oauth2.googleapis.com/token",
+        }, f)
+
+
+# ——— LADO DO APP (SUBPROCESSO) ———
+def redirecionar_google(url_fake: str):
+    """Desvia para o servidor falso toda chamada `requests` (gspread, google-auth, Apps Script) ao Google."""
+    original = requests.Session.request
+
+    def request(self, method, url, *args, **kwargs):
+        partes = urlsplit(url)
+        if partes.hostname in HOSTS_GOOGLE:
+            url = url_fake + partes.path + (f"?{partes.query}" if partes.query else "")
+        return original(self, method, url, *args, **kwargs)
+
+    requests.Session.request = request
+
+
+def servir_app(modulo: str, porta: int, url_fake: str, processos: int):
+    redirecionar_google(url_fake)
+    sys.path.insert(0, REPO_DIR)
+    mod = importlib.import_module(modulo)
+    app = mod.app
+
+    template = os.path.join(app.root_path, app.template_folder or "templates", "index.html")
+    if not os.path.exists(template):
+        from jinja2 import DictLoader
+        app.jinja_loader = DictLoader({"index.html": "<pre>{{ msg }}</pre>"})
+
+    if modulo == "server":
+        def upload_pdf_to_drive(local_pdf_path, title=None):
+            with open(local_pdf_path, "rb") as f:
+                resp = requests.post(
+                    "https://www.googleapis.com/upload/drive/v3/files?uploadType=multipart",
+                    files={"file": (title or os.path.basename(local_pdf_path), f, "application/pdf")},
+                )
+            resp.raise_for_status()
+            return resp.json()["id"]
+
+        mod.upload_pdf_to_drive = upload_pdf_to_drive
+        mod.WEBAPP_URL = "https://script.google.com/macros/s/carga/exec"
+
+    app.run(host="127.0.0.1", port=porta, debug=False, use_reloader=False,
+            threaded=processos <= 1, processes=max(1, processos))
+
+
+# ——— LADO DO DISPARADOR ———
+def porta_livre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def aguardar_porta(porta: int, processo, timeout=60):
+    limite = time.time() + timeout
+    while time.time() < limite:
+        if processo.poll() is not None:
+            raise RuntimeError(f"app encerrou ao subir (código {processo.returncode})")
+        try:
+            with socket.create_connection(("127.0.0.1", porta), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"app não abriu a porta {porta} em {timeout}s")
+
+
+def resposta_com_erro(resp) -> bool:
+    if resp.status_code >= 400:
+        return True
+    if "[ERRO]" in resp.text:
+        return True
+    if resp.headers.get("Content-Type", "").startswith("application/json"):
+        corpo = resp.json()
+        return corpo.get("success") is False or str(corpo.get("status", "ok")).startswith("erro")
+    return False
+
+
+def disparar(nome: str, porta: int, args, pasta: str) -> dict:
+    alvo = ALVOS[nome]
+    url = f"http://127.0.0.1:{porta}{alvo['rota']}"
+    latencias, erros = [], Counter()
+    lock = threading.Lock()
+    contador = iter(range(10**9))
+
+    def uma_requisicao(_):
+        n = next(contador)
+        instalacoes = [[str(3000000000 + n * 1000 + p * 100 + c) for c in range(args.contas_por_pdf)]
+                       for p in range(args.pdfs)]
+        inicio = time.perf_counter()
+        try:
+            if alvo["formato"] == "multipart":
+                arquivos = [("pdfs", (f"conta_{n}_{i}.pdf", gerar_pdf_contas(inst), "application/pdf"))
+                            for i, inst in enumerate(instalacoes)]
+                # o importador agenda por usuário (campo 'usuario'); sem ele todos seriam o mesmo IP
+                resp = requests.post(url, files=arquivos, data={"usuario": f"carga{n % args.usuarios}"},
+                                     timeout=args.timeout)
+            else:
+                caminho = os.path.join(pasta, f"conta_{n}.pdf")
+                with open(caminho, "wb") as f:
+                    f.write(gerar_pdf_contas(instalacoes[0]))
+                resp = requests.post(url, json={"pdf_path": caminho, "cliente": str(n)}, timeout=args.timeout)
+            falhou = resposta_com_erro(resp)
+            motivo = f"HTTP {resp.status_code}" if resp.status_code >= 400 else "erro no corpo"
+        except requests.RequestException as e:
+            falhou, motivo = True, type(e).__name__
+        duracao = time.perf_counter() - inicio
+        with lock:
+            latencias.append(duracao)
+            if falhou:
+                erros[motivo] += 1
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concorrencia) as pool:
+        list(pool.map(uma_requisicao, range(args.requisicoes)))
+    total = time.perf_counter() - inicio
+
+    latencias.sort()
+
+    def percentil(p):
+        return latencias[min(len(latencias) - 1, int(p / 100 * len(latencias)))] * 1000 if latencias else 0.0
+
+    return {
+        "endpoint": f"{nome} {alvo['rota']}",
+        "requisicoes": len(latencias),
+        "contas": len(latencias) * args.pdfs * args.contas_por_pdf,
+        "duracao_s": round(total, 3),
+        "req_por_s": round(len(latencias) / total, 2) if total else 0.0,
+        "p50_ms": round(percentil(50), 1),
+        "p90_ms": round(percentil(90), 1),
+        "p99_ms": round(percentil(99), 1),
+        "max_ms": round(latencias[-1] * 1000, 1) if latencias else 0.0,
+        "taxa_erro": round(sum(erros.values()) / len(latencias), 4) if latencias else 0.0,
+        "erros": dict(erros),
+    }
+
+
+def imprimir_relatorio(resultados: list, stats_fake: dict):
+    print()
+    print(f"{'endpoint':<22}{'req':>6}{'req/s':>9}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}{'erro %':>9}")
+    for r in resultados:
+        if "falha" in r:
+            print(f"{r['endpoint']:<22}  não executado: {r['falha']}")
+            continue
+        print(f"{r['endpoint']:<22}{r['requisicoes']:>6}{r['req_por_s']:>9}{r['p50_ms']:>10}{r['p90_ms']:>10}"
+              f"{r['p99_ms']:>10}{r['max_ms']:>10}{r['taxa_erro'] * 100:>8.1f}%")
+        if r["erros"]:
+            print(f"{'':<22}  erros: {r['erros']}")
+    print()
+    print(f"[FAKE] linhas gravadas na planilha falsa: {stats_fake['linhas_gravadas']}")
+    for rota, status in sorted(stats_fake["rotas"].items()):
+        print(f"[FAKE] {rota:<22} {dict(status)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Teste de carga dos apps com Google simulado localmente.")
+    parser.add_argument("--apps", default="importador", help="lista separada por vírgula: " + ",".join(ALVOS))
+    parser.add_argument("--requisicoes", type=int, default=50)
+    parser.add_argument("--concorrencia", type=int, default=8)
+    parser.add_argument("--pdfs", type=int, default=1, help="PDFs por requisição")
+    parser.add_argument("--contas-por-pdf", type=int, default=1, help=">1 gera PDFs consolidados")
+    parser.add_argument("--usuarios", type=int, default=1, help="usuários simulados (rodízio entre eles)")
+    parser.add_argument("--processos", type=int, default=1, help="processos do servidor do app (1 = threads)")
+    parser.add_argument("--latencia-ms", type=float, default=50)
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--taxa-erro", type=float, default=0.0, help="fração de respostas 500 do Google falso")
+    parser.add_argument("--taxa-429", type=float, default=0.0, help="fração de respostas 429 do Google falso")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--json", help="grava o relatório também em JSON")
+    # uso interno: modo subprocesso
+    parser.add_argument("--servir-app", help=argparse.SUPPRESS)
+    parser.add_argument("--porta", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--fake", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.servir_app:
+        servir_app(args.servir_app, args.porta, args.fake, args.processos)
+        return
+
+    estado = EstadoFake(args.latencia_ms, args.jitter_ms, args.taxa_erro, args.taxa_429)
+    servidor, url_fake = iniciar_fake_google(estado)
+    print(f"[CARGA] Google falso em {url_fake}")
+
+    resultados = []
+    for nome in [a.strip() for a in args.apps.split(",") if a.strip()]:
+        if nome not in ALVOS:
+            parser.error(f"app desconhecido: {nome}")
+        with tempfile.TemporaryDirectory(prefix=f"carga_{nome}_") as pasta:
+            gerar_credencial_falsa(os.path.join(pasta, "client_secret.json"))
+            porta = porta_livre()
+            log = open(os.path.join(pasta, "app.log"), "w")
+            processo = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), "--servir-app", nome, "--porta", str(porta),
+                 "--fake", url_fake, "--processos", str(args.processos)],
+                cwd=pasta, stdout=log, stderr=subprocess.STDOUT,
+            )
+            try:
+                aguardar_porta(porta, processo)
+                print(f"[CARGA] {nome}: {args.requisicoes} requisições, concorrência {args.concorrencia}")
+                resultados.append(disparar(nome, porta, args, pasta))
+            except RuntimeError as e:
+                log.flush()
+                with open(os.path.join(pasta, "app.log")) as f:
+                    cauda = f.read()[-2000:]
+                print(f"[CARGA] {nome}: {e}\n{cauda}")
+                resultados.append({"endpoint": f"{nome} {ALVOS[nome]['rota']}", "falha": str(e)})
+            finally:
+                processo.terminate()
+                processo.wait(timeout=10)
+                log.close()
+
+    stats_fake = requests.get(f"{url_fake}/__stats").json()
+    servidor.shutdown()
+    imprimir_relatorio(resultados, stats_fake)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"parametros": vars(args), "endpoints": resultados, "google_falso": stats_fake},
+                      f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
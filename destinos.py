@@ -0,0 +1,74 @@
+import threading
+import time
+
+import gspread
+from oauth2client.service_account import ServiceAccountCredentials
+
+SCOPE = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+
+# ——— POOL DE PLANILHAS DE DESTINO ———
+# Um cliente gspread autorizado por arquivo de credencial e uma aba aberta por (planilha, aba),
+# com o cabeçalho em cache por TTL_HEADERS segundos. Tudo é reaproveitado entre requisições.
+TTL_HEADERS = 600
+
+
+class PoolPlanilhas:
+    def __init__(self, scope=SCOPE):
+        self.scope = scope
+        self._clientes = {}
+        self._abas = {}
+        self._lock = threading.Lock()
+
+    def cliente(self, credencial: str):
+        with self._lock:
+            cliente = self._clientes.get(credencial)
+            if cliente is None:
+                creds = ServiceAccountCredentials.from_json_keyfile_name(credencial, self.scope)
+                cliente = self._clientes[credencial] = gspread.authorize(creds)
+                print(f"[DESTINO] cliente autorizado para {credencial}")
+            return cliente
+
+    def obter(self, planilha_url: str, aba: str, credencial: str) -> tuple:
+        """Retorna (worksheet, headers) do destino, abrindo a aba só na primeira vez."""
+        chave = (planilha_url, aba, credencial)
+        with self._lock:
+            entrada = self._abas.get(chave)
+        if entrada is None:
+            worksheet = self.cliente(credencial).open_by_url(planilha_url).worksheet(aba)
+            entrada = [worksheet, worksheet.row_values(1), time.monotonic()]
+            with self._lock:
+                self._abas[chave] = entrada
+        elif time.monotonic() - entrada[2] > TTL_HEADERS:
+            entrada[1] = entrada[0].row_values(1)
+            entrada[2] = time.monotonic()
+        return entrada[0], entrada[1]
+
+
+# ——— REGRAS DE ROTEAMENTO ———
+def regra_atende(regra: dict, dados: dict, formulario: dict) -> bool:
+    """
+    Uma regra olha um campo extraído ("campo") ou um campo do formulário de upload ("form")
+    e compara por igualdade ("igual") ou prefixo ("prefixo").
+    """
+    if "form" in regra:
+        valor = (formulario.get(regra["form"]) or "").strip()
+    else:
+        valor = (dados.get(regra.get("campo", "")) or "").strip()
+    if "igual" in regra:
+        return valor == regra["igual"]
+    if "prefixo" in regra:
+        return bool(valor) and valor.startswith(regra["prefixo"])
+    return False
+
+
+def escolher_destino(regras: list, dados: dict, formulario: dict, padrao: tuple) -> tuple:
+    """Primeira regra que atende define (planilha, aba, credencial); senão vale o `padrao`."""
+    for regra in regras:
+        if regra_atende(regra, dados, formulario):
+            return (regra.get("planilha", padrao[0]), regra.get("aba", padrao[1]), regra.get("credencial", padrao[2]))
+    return padrao
+
+
+def reordenar_linha(dados: dict, headers_destino: list) -> list:
+    """Monta a linha na ordem das colunas do destino; colunas que o parser não conhece ficam '0'."""
+    return [dados.get(h, "0") for h in headers_destino]
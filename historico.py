@@ -0,0 +1,151 @@
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+# ——— HISTÓRICO DE CONSUMO POR INSTALAÇÃO ———
+# Cópia local, em SQLite, de cada linha gravada na aba CONTAS, com chave primária
+# (instalacao, referencia, nota_fiscal) para que a série de uma instalação seja uma leitura de
+# intervalo no índice, e um índice por referência para os agregados mensais.
+# fatDataReferencia é o mês do processamento, então duas contas da mesma instalação importadas
+# no mesmo mês só se distinguem pela nota fiscal (ou, sem ela, pelo código de barras).
+CAMPO_KWH = "fatConFPontaIndRegistrado"
+CAMPO_VALOR = "fatValorFatura"
+CAMPOS_INSTALACAO = ("instalacao", "Instalação")
+CAMPOS_IDENTIFICADOR = ("NOTAFISCAL", "fatCodigoBarras")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS contas (
+    instalacao  TEXT NOT NULL,
+    referencia  TEXT NOT NULL,
+    nota_fiscal TEXT NOT NULL,
+    kwh         REAL,
+    valor       REAL,
+    linha       TEXT NOT NULL,
+    gravado_em  TEXT NOT NULL,
+    PRIMARY KEY (instalacao, referencia, nota_fiscal)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_contas_referencia ON contas (referencia, instalacao, kwh, valor);
+"""
+
+_local = threading.local()
+
+
+def _conexao(caminho: str) -> sqlite3.Connection:
+    conexoes = getattr(_local, "conexoes", None)
+    if conexoes is None:
+        conexoes = _local.conexoes = {}
+    con = conexoes.get(caminho)
+    if con is None:
+        con = sqlite3.connect(caminho)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        _migrar_chave_antiga(con)
+        con.executescript(_SCHEMA)
+        conexoes[caminho] = con
+    return con
+
+
+def _migrar_chave_antiga(con: sqlite3.Connection):
+    """Bancos criados com a chave (instalacao, referencia) ganham a coluna nota_fiscal na chave."""
+    colunas = [c[1] for c in con.execute("PRAGMA table_info(contas)")]
+    if not colunas or "nota_fiscal" in colunas:
+        return
+    with con:
+        con.execute("ALTER TABLE contas RENAME TO contas_antiga")
+        con.execute("DROP INDEX IF EXISTS idx_contas_referencia")
+        con.executescript(_SCHEMA)
+        for instalacao, referencia, kwh, valor, linha, gravado_em in con.execute("SELECT * FROM contas_antiga").fetchall():
+            con.execute("INSERT OR REPLACE INTO contas VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (instalacao, referencia, identificador_conta(json.loads(linha)), kwh, valor, linha, gravado_em))
+        con.execute("DROP TABLE contas_antiga")
+
+
+def identificador_conta(dados: dict) -> str:
+    return next((str(dados[c]) for c in CAMPOS_IDENTIFICADOR if dados.get(c) not in (None, "", "0")), "")
+
+
+def numero_br(valor: str):
+    """'1.234,56' → 1234.56, '1.520' → 1520.0 (ponto é sempre milhar); vazio ou inválido → None."""
+    valor = (valor or "").strip().replace("R$", "").replace(" ", "")
+    if not valor:
+        return None
+    valor = valor.replace(".", "").replace(",", ".")
+    try:
+        return float(valor)
+    except ValueError:
+        return None
+
+
+def mes_referencia(data: str) -> str:
+    """'01/07/2025' → '2025-07'; aceita também '2025-07' e '2025-07-01'."""
+    data = (data or "").strip()
+    for formato in ("%d/%m/%Y", "%Y-%m-%d", "%Y-%m", "%m/%Y"):
+        try:
+            return datetime.strptime(data, formato).strftime("%Y-%m")
+        except ValueError:
+            continue
+    return ""
+
+
+def registrar_linhas(caminho: str, headers: list, linhas: list) -> int:
+    """
+    Grava no histórico as linhas enviadas à planilha; a mesma conta (instalação, mês e nota fiscal)
+    enviada de novo substitui a anterior.
+    Linhas sem instalação ou sem fatDataReferencia válida são ignoradas. Retorna quantas entraram.
+    """
+    agora = datetime.now().isoformat(timespec="seconds")
+    registros = []
+    for linha in linhas:
+        dados = dict(zip(headers, linha))
+        instalacao = next((dados[c] for c in CAMPOS_INSTALACAO if dados.get(c) not in (None, "", "0")), "")
+        referencia = mes_referencia(dados.get("fatDataReferencia", ""))
+        if not instalacao or not referencia:
+            continue
+        registros.append((
+            instalacao, referencia, identificador_conta(dados),
+            numero_br(dados.get(CAMPO_KWH, "")), numero_br(dados.get(CAMPO_VALOR, "")),
+            json.dumps(dados, ensure_ascii=False), agora,
+        ))
+
+    if registros:
+        con = _conexao(caminho)
+        with con:
+            con.executemany("INSERT OR REPLACE INTO contas VALUES (?, ?, ?, ?, ?, ?, ?)", registros)
+    return len(registros)
+
+
+def serie_instalacao(caminho: str, instalacao: str, meses: int = 24, campos: list = None) -> list:
+    """Contas dos últimos `meses` meses da instalação, do mais antigo para o mais recente."""
+    con = _conexao(caminho)
+    linhas = con.execute(
+        "SELECT referencia, nota_fiscal, kwh, valor, linha FROM contas WHERE instalacao = ? AND referencia IN ("
+        "SELECT DISTINCT referencia FROM contas WHERE instalacao = ? ORDER BY referencia DESC LIMIT ?) "
+        "ORDER BY referencia, nota_fiscal",
+        (instalacao, instalacao, meses),
+    ).fetchall()
+    serie = []
+    for referencia, nota_fiscal, kwh, valor, linha in linhas:
+        ponto = {"referencia": referencia, "nota_fiscal": nota_fiscal, "kwh": kwh, CAMPO_VALOR: valor}
+        if campos:
+            dados = json.loads(linha)
+            ponto.update({c: dados.get(c) for c in campos})
+        serie.append(ponto)
+    return serie
+
+
+def agregados_mensais(caminho: str, de: str = "", ate: str = "", prefixo_instalacao: str = "") -> list:
+    """Totais por mês de referência (contas, kWh, valor total e médio) no intervalo [de, ate]."""
+    con = _conexao(caminho)
+    sql = ("SELECT referencia, COUNT(*), SUM(kwh), SUM(valor), AVG(valor) FROM contas "
+           "WHERE referencia BETWEEN ? AND ?")
+    params = [de or "0000-00", ate or "9999-99"]
+    if prefixo_instalacao:
+        sql += " AND instalacao >= ? AND instalacao < ?"
+        params += [prefixo_instalacao, prefixo_instalacao + "\uffff"]
+    sql += " GROUP BY referencia ORDER BY referencia"
+    return [
+        {"referencia": r, "contas": n, "kwh": kwh, "valor_total": total,
+         "valor_medio": round(media, 2) if media is not None else None}
+        for r, n, kwh, total, media in con.execute(sql, params)
+    ]
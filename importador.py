@@ -1,17 +1,39 @@
-from flask import Flask, render_template, request
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-import pdfplumber
+from flask import Flask, render_template, request, jsonify, send_from_directory, abort, Response
+from werkzeug.utils import secure_filename
 import os
 import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+import csv
+import hashlib
+import cProfile
+import io
+import json
+import pstats
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import as_completed
+from backends_pdf import abrir_pdf, BACKENDS, dividir_pdf, primeira_pagina_sem_texto
+from cache_paginas import gravar_cache, compactar_paginas, listar_cache, ler_entrada, salvar_entrada, EXTENSAO_CACHE, hash_conteudo
+import historico
+import cache_fontes
+from destinos import PoolPlanilhas, escolher_destino, reordenar_linha
+from agendador import Agendador, PRIORIDADE_ALTA, PRIORIDADE_NORMAL
+import uuid
 
 # ——— DETECÇÃO DE TIPO DE CONTA ———
 def detectar_tipo_conta_inicial(pdf_path: str) -> str:
-    with pdfplumber.open(pdf_path) as pdf:
+    with abrir_pdf(pdf_path) as pdf:
         texto = pdf.pages[0].extract_text() or ""
         texto_upper = texto.upper()
 
+        if not texto.strip():
+            return detectar_tipo_conta_ocr(pdf_path)
+
         if "THS VERDE A4" in texto_upper or ("GRUPO A" in texto_upper and "THS" in texto_upper and "VERDE" in texto_upper):
             return "THS_VERDE_A4"
         elif "A4 VERDE" in texto_upper or ("GRUPO A" in texto_upper and "TUSD" in texto_upper):
@@ -21,6 +43,50 @@ def detectar_tipo_conta_inicial(pdf_path: str) -> str:
         else:
             return "DESCONHECIDO"
 
+# ——— SEPARAÇÃO DE PDFs CONSOLIDADOS ———
+REGEX_INSTALACAO = re.compile(r"Nº DA INSTALAÇÃO\s*(\d+)")
+
+def detectar_fronteiras_contas(textos: list) -> list:
+    """
+    Agrupa as páginas por conta: uma nova conta começa na página cujo cabeçalho
+    'Nº DA INSTALAÇÃO' traz uma instalação diferente da conta atual.
+    Páginas sem cabeçalho ficam com a conta anterior.
+    Retorna [(instalacao, [índices das páginas])].
+    """
+    contas = []
+    for i, texto in enumerate(textos):
+        match = REGEX_INSTALACAO.search(texto)
+        instalacao = match.group(1) if match else None
+        if not contas or (instalacao and instalacao != contas[-1][0]):
+            contas.append((instalacao or "", [i]))
+        else:
+            contas[-1][1].append(i)
+    return contas
+
+def separar_contas(pdf_path: str) -> list:
+    """
+    Divide um PDF consolidado em um arquivo por conta, ao lado do original.
+    Retorna [(instalacao, caminho, paginas)]; PDFs com uma única conta voltam inalterados.
+    """
+    partes = dividir_pdf(pdf_path, detectar_fronteiras_contas)
+    if len(partes) > 1:
+        print(f"[DEBUG] {os.path.basename(pdf_path)} → {len(partes)} contas separadas")
+    return partes
+
+def detectar_tipo_conta_ocr(pdf_path: str) -> str:
+    """Conta escaneada: lê por OCR só o retângulo do subgrupo (mesmo usado na validação do B3)."""
+    try:
+        with abrir_pdf(pdf_path, "ocr") as pdf:
+            subgrupo = extrair_na_bbox(pdf.pages[0], *COORDENADAS_B3["J"]).upper()
+    except Exception as e:
+        print(f"[ERRO] OCR do subgrupo falhou: {e}")
+        return "DESCONHECIDO"
+    if "B3" in subgrupo:
+        return "B3"
+    if "A4" in subgrupo:
+        return "A4_VERDE"
+    return "DESCONHECIDO"
+
 def detectar_multa_ou_padrao(page, resultados=None) -> dict:
     """
     Verifica se existem as palavras 'multa', 'juros' ou 'correção' dentro da área de energia (x0 <= 305),
@@ -54,14 +120,7 @@ def detectar_multa_ou_padrao(page, resultados=None) -> dict:
             deslocamento = 10
 
         # Coordenadas padrão
-        coordenadas = {
-            'DG': (305.55, 290.57, 338.65, 300.19),
-            'CT': (305.15, 300.18, 338.66, 309.79),
-            'CQ': (305.15, 309.77, 338.66, 319.39),
-            'CN': (305.15, 319.38, 338.66, 328.99),
-            'CV': (305.15, 328.98, 338.66, 338.59),
-            'DC': (305.55, 348.18, 338.65, 357.79),
-        }
+        coordenadas = dict(COORDENADAS_MULTA_PADRAO)
 
         if deslocamento != 0:
             print(f"[DEBUG] Aplicando deslocamento de {deslocamento:+}px em Y nas coordenadas devido a {n_termos} termo(s) encontrado(s)...")
@@ -104,10 +163,10 @@ def extrair_fatDescontoFio(texto: str) -> str:
 
 
 # ——— PARSER TUSD A4 VERDE (MÓDULO ATUALIZADO) ———
-def extrair_por_regras_a4_verde(pdf_path: str) -> list:
+def extrair_por_regras_a4_verde(pdf_path: str, backend: str = None) -> list:
     resultados = {h: "" for h in headers}
 
-    with pdfplumber.open(pdf_path) as pdf:
+    with abrir_conta(pdf_path, backend or BACKEND_POR_TIPO["A4_VERDE"]) as pdf:
         total = len(pdf.pages)
         print(f"[DEBUG] A4 Verde → {total} pág.")
         print(">>> CHAVES A4:", list(COORDENADAS_A4.keys()))
@@ -228,15 +287,45 @@ PLANILHA_URL = "https://docs.google.com/spreadsheets/d/170LPTCD-_9Dk6oOt6D2SGNr7
 ABA = "CONTAS"
 CREDENCIAL = "client_secret.json"
 
+# Roteamento de linhas para outras planilhas/abas (ver destinos.py). A primeira regra que atender vale;
+# sem regra, a linha vai para PLANILHA_URL/ABA. Exemplos:
+#   {"campo": "concCod", "igual": "22", "planilha": "https://docs.google.com/...", "aba": "CEMIG"}
+#   {"campo": "Instalação", "prefixo": "300", "planilha": "https://docs.google.com/..."}
+#   {"form": "cliente", "igual": "acme", "planilha": "https://...", "credencial": "acme_secret.json"}
+REGRAS_DESTINO = []
+
+# Pasta do cache de páginas (ver cache_paginas.py); None desliga o cache.
+# Com o cache ligado: python importador.py --reextrair <pasta> [diff.csv] [--gravar]
+CACHE_PAGINAS_DIR = None
+
+# Perfil sob demanda: com PERFIL_HABILITADO, um upload com o header 'X-Perfil: 1' ou '?perfil=1'
+# é processado sob cProfile e o resultado fica em PERFIL_DIR (listagem em /perfis)
+PERFIL_HABILITADO = False
+PERFIL_DIR = "perfis"
+
+# Histórico local por instalação (ver historico.py), atualizado a cada linha gravada; None desliga.
+# Consultas: GET /historico/<instalacao>?meses=24  e  GET /historico/agregados?de=2024-01&ate=2025-06
+# Carga inicial a partir da planilha: python importador.py --importar-historico
+HISTORICO_DB = None   # ex.: "historico.sqlite3"
+
+# Fontes/CMaps decodificados são reaproveitados entre contas no mesmo processo (ver cache_fontes.py);
+# com uma pasta aqui, também entre execuções. Benchmark: python cache_fontes.py contas/*.pdf
+cache_fontes.MAX_FONTES_CACHE = 256
+cache_fontes.FONTES_CACHE_DIR = None
+
+# Backend de leitura por layout ("pdfplumber" ou "pdfium"); ver backends_pdf.py
+# Antes de trocar, rode: python importador.py --comparar-backends B3 contas/*.pdf
+BACKEND_POR_TIPO = {
+    "B3": "pdfplumber",
+    "A4_VERDE": "pdfplumber",
+}
+
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
-scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-creds = ServiceAccountCredentials.from_json_keyfile_name(CREDENCIAL, scope)
-client = gspread.authorize(creds)
-sheet = client.open_by_url(PLANILHA_URL)
-worksheet = sheet.worksheet(ABA)
-headers = worksheet.row_values(1)
+planilhas = PoolPlanilhas()
+DESTINO_PADRAO = (PLANILHA_URL, ABA, CREDENCIAL)
+worksheet, headers = planilhas.obter(*DESTINO_PADRAO)
 
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
@@ -267,6 +356,17 @@ COORDENADAS_B3 = {
     'CR': (407.15, 678.9, 453.89, 689.89),
 }
 
+# ——— COORDENADAS B3 SUJEITAS AO DESLOCAMENTO DE MULTA/JUROS/CORREÇÃO ———
+# (ver detectar_multa_ou_padrao)
+COORDENADAS_MULTA_PADRAO = {
+    'DG': (305.55, 290.57, 338.65, 300.19),
+    'CT': (305.15, 300.18, 338.66, 309.79),
+    'CQ': (305.15, 309.77, 338.66, 319.39),
+    'CN': (305.15, 319.38, 338.66, 328.99),
+    'CV': (305.15, 328.98, 338.66, 338.59),
+    'DC': (305.55, 348.18, 338.65, 357.79),
+}
+
 # ——— MAPEAMENTO POR NOME DO HEADER PARA TUSD A4 VERDE ———
 # ——— COORDENADAS PARA A4 VERDE ———
 # chave = letra da coluna, valor = (página, x0, y0, x1, y1)
@@ -339,14 +439,52 @@ def get_column_letter(n: int) -> str:
     return result
 
 def extrair_na_bbox(page, x0, y0, x1, y1, margem=1.5) -> str:
+    chamadas = getattr(_perfil_local, "chamadas_bbox", None)
+    inicio = time.perf_counter() if chamadas is not None else 0.0
     top, bottom = min(y0, y1), max(y0, y1)
     rec = page.within_bbox((x0 - margem, top - margem, x1 + margem, bottom + margem))
     txt = rec.extract_text()
     print(f"[DEBUG] bbox=({x0}, {y0}, {x1}, {y1}) → '{txt.strip() if txt else ''}'")
+    if chamadas is not None:
+        chamadas.append({"bbox": [x0, y0, x1, y1], "texto": txt.strip() if txt else "",
+                         "ms": round((time.perf_counter() - inicio) * 1000, 3)})
     return txt.strip() if txt else ""
 
+def comparar_backends(caminhos: list, tipo: str = "B3") -> list:
+    """
+    Roda o parser do layout `tipo` com cada backend e compara as linhas inteiras, o que inclui
+    os campos tirados por regex do texto da página e o deslocamento de multa/juros/correção.
+    Retorna [(arquivo, header, {backend: valor})] apenas para os campos em que os backends discordam.
+    """
+    parser = extrair_por_regras if tipo == "B3" else extrair_por_regras_a4_verde
+    divergencias = []
+    tempos = {b: 0.0 for b in BACKENDS}
+
+    for caminho in caminhos:
+        por_backend = {}
+        for backend in BACKENDS:
+            inicio = time.perf_counter()
+            try:
+                por_backend[backend] = dict(zip(headers, parser(caminho, backend)))
+            except Exception as e:
+                por_backend[backend] = {h: f"[ERRO] {e}" for h in headers}
+            tempos[backend] += time.perf_counter() - inicio
+
+        for h in headers:
+            if h in CAMPOS_DATA_PROCESSAMENTO:
+                continue
+            valores = {b: por_backend[b][h] for b in BACKENDS}
+            if len(set(valores.values())) > 1:
+                divergencias.append((os.path.basename(caminho), h, valores))
+                print(f"[COMPARA] {os.path.basename(caminho)} {h}: {valores}")
+
+    for backend, total in tempos.items():
+        print(f"[COMPARA] {backend}: {total:.3f}s em {len(caminhos)} arquivo(s)")
+    print(f"[COMPARA] {len(divergencias)} divergência(s) no layout {tipo}")
+    return divergencias
+
 def diagnosticar_vazios_na_pagina(pdf_path):
-    with pdfplumber.open(pdf_path) as pdf:
+    with abrir_pdf(pdf_path) as pdf:
         for i, page in enumerate(pdf.pages, start=1):
             texto = page.extract_text() or ""
 
@@ -381,9 +519,8 @@ def diagnosticar_vazios_na_pagina(pdf_path):
 
 def visualizar_bbox(pdf_path, pagina, x0, y0, x1, y1):
     import matplotlib.pyplot as plt
-    import pdfplumber
 
-    with pdfplumber.open(pdf_path) as pdf:
+    with abrir_pdf(pdf_path) as pdf:
         page = pdf.pages[pagina - 1]
         im = page.to_image(resolution=150)
         im.draw_rect((x0, y0, x1, y1), stroke="red", fill=None)
@@ -443,10 +580,10 @@ def extrair_numero_nota_fiscal(texto: str) -> str:
     return match.group(1) if match else ""
 
 
-def extrair_por_regras(pdf_path: str) -> list:
+def extrair_por_regras(pdf_path: str, backend: str = None) -> list:
     resultados = {h: "" for h in headers}
 
-    with pdfplumber.open(pdf_path) as pdf:
+    with abrir_conta(pdf_path, backend or BACKEND_POR_TIPO["B3"]) as pdf:
         page = pdf.pages[0]
         texto_completo = page.extract_text() or ""
 
@@ -556,6 +693,529 @@ def extrair_por_regras(pdf_path: str) -> list:
 
     return [resultados[h] for h in headers]
 
+# ——— PROCESSAMENTO DE UMA CONTA ———
+class TipoNaoSuportado(Exception):
+    pass
+
+# Com o cache de páginas ligado, processar_conta ativa a captura na thread e o documento aberto
+# pelo parser é compactado antes de fechar, sem abrir e parsear o PDF uma segunda vez.
+_captura_local = threading.local()
+
+@contextmanager
+def abrir_conta(pdf_path: str, backend: str):
+    with abrir_pdf(pdf_path, backend) as pdf:
+        yield pdf
+        if getattr(_captura_local, "ativa", False):
+            _captura_local.paginas = compactar_paginas(pdf.pages)
+
+def processar_conta(caminho: str, tipo_detectado: str = None, backend: str = None) -> tuple:
+    """
+    Classifica (se `tipo_detectado` não vier) e extrai uma única conta. Retorna (tipo_detectado, linha).
+    `backend` vem de backend_da_conta ("ocr" para contas escaneadas); None usa BACKEND_POR_TIPO.
+    """
+    if tipo_detectado is None:
+        tipo_detectado = detectar_tipo_conta_inicial(caminho)
+
+    # Contas escaneadas não têm caracteres para guardar
+    capturar = bool(CACHE_PAGINAS_DIR) and backend != "ocr" and not caminho.endswith(EXTENSAO_CACHE)
+    _captura_local.ativa, _captura_local.paginas = capturar, None
+    try:
+        if tipo_detectado == "B3":
+            linha = extrair_por_regras(caminho, backend)
+            tarifa_cod = "3"
+            subgrupo_cod = "6"
+        elif tipo_detectado == "A4_VERDE":
+            linha = extrair_por_regras_a4_verde(caminho, backend)
+            tarifa_cod = "1"
+            subgrupo_cod = "5"
+        elif tipo_detectado == "THS_VERDE_A4":
+            linha = extrair_por_regras_ths_verde_a4(caminho)
+            tarifa_cod = "2"
+            subgrupo_cod = "7"
+        else:
+            raise TipoNaoSuportado("Tipo de conta não suportado.")
+    finally:
+        _captura_local.ativa = False
+    paginas_capturadas, _captura_local.paginas = _captura_local.paginas, None
+
+    # Atualiza os campos se existirem no header
+    if "cadTarifaCod" in headers:
+        idx_tarifa = headers.index("cadTarifaCod")
+        linha[idx_tarifa] = tarifa_cod
+    if "cadSubGrupoCod" in headers:
+        idx_subgrupo = headers.index("cadSubGrupoCod")
+        linha[idx_subgrupo] = subgrupo_cod
+
+    if capturar:
+        try:
+            gravar_cache(caminho, CACHE_PAGINAS_DIR, {
+                "arquivo": os.path.basename(caminho),
+                "tipo": tipo_detectado,
+                "layout": impressao_layout(tipo_detectado),
+                "headers": list(headers),
+                "linha": list(linha),
+            }, paginas_capturadas)
+        except Exception as e:
+            print(f"[ERRO] ao gravar cache de páginas de {caminho}: {e}")
+
+    return tipo_detectado, linha
+
+# ——— REEXTRAÇÃO A PARTIR DO CACHE DE PÁGINAS ———
+# Campos preenchidos com a data do processamento, não com o conteúdo da conta
+CAMPOS_DATA_PROCESSAMENTO = ("fatDataCadastro", "fatDataReferencia")
+
+def impressao_layout(tipo: str) -> str:
+    """Hash das coordenadas usadas pelo parser do tipo; muda sempre que o layout for ajustado."""
+    if tipo == "B3":
+        coords = (COORDENADAS_B3, COORDENADAS_MULTA_PADRAO)
+    elif tipo == "A4_VERDE":
+        coords = COORDENADAS_A4
+    else:
+        coords = ()
+    return hashlib.sha1(repr(coords).encode("utf-8")).hexdigest()
+
+def reextrair_cache(pasta: str, saida_diff: str = None, gravar: bool = False) -> list:
+    """
+    Reexecuta os parsers sobre as contas do cache cujo layout mudou desde a última extração
+    e lista as células alteradas: [(chave, arquivo, header, antes, depois)].
+    Com `gravar`, a linha e a impressão do layout guardadas no cache são atualizadas.
+    """
+    diferencas = []
+    entradas = listar_cache(pasta)
+    reextraidas = 0
+    inicio = time.perf_counter()
+
+    for caminho in entradas:
+        entrada = ler_entrada(caminho)
+        meta = entrada["meta"]
+        if meta.get("layout") == impressao_layout(meta.get("tipo")):
+            continue
+
+        chave = os.path.basename(caminho)[:-len(EXTENSAO_CACHE)]
+        try:
+            tipo, linha = processar_conta(caminho)
+        except Exception as e:
+            print(f"[ERRO] reextração de {meta.get('arquivo')} ({chave[:12]}): {e}")
+            continue
+        reextraidas += 1
+
+        antes = dict(zip(meta.get("headers", []), meta.get("linha", [])))
+        depois = dict(zip(headers, linha))
+        for h in headers:
+            if h in CAMPOS_DATA_PROCESSAMENTO:
+                continue
+            if antes.get(h) != depois[h]:
+                diferencas.append((chave, meta.get("arquivo", ""), h, antes.get(h, ""), depois[h]))
+
+        if gravar:
+            meta.update(tipo=tipo, layout=impressao_layout(tipo), headers=list(headers), linha=linha)
+            salvar_entrada(caminho, entrada)
+
+    print(f"[REEXTRAÇÃO] {reextraidas}/{len(entradas)} conta(s) reextraída(s) em {time.perf_counter() - inicio:.2f}s, "
+          f"{len(diferencas)} célula(s) alterada(s)")
+
+    if saida_diff:
+        with open(saida_diff, "w", newline="", encoding="utf-8") as f:
+            escritor = csv.writer(f)
+            escritor.writerow(["chave", "arquivo", "campo", "antes", "depois"])
+            escritor.writerows(diferencas)
+    else:
+        for chave, arquivo, h, a, d in diferencas:
+            print(f"[DIFF] {arquivo} ({chave[:12]}) {h}: '{a}' → '{d}'")
+
+    return diferencas
+
+def _processar_conta_isolada(caminho: str, backend: str = None) -> tuple:
+    # Executado nos processos do pool: devolve o erro em vez de levantar,
+    # para que uma conta ruim não derrube as demais do mesmo arquivo.
+    try:
+        return processar_conta(caminho, backend=backend) + (None,)
+    except Exception as e:
+        return None, None, str(e)
+
+# ——— POOL DE PROCESSOS PARA PDFs CONSOLIDADOS ———
+MAX_PROCESSOS_CONTAS = os.cpu_count() or 1
+_pool_contas = None
+
+def obter_pool_contas() -> ProcessPoolExecutor:
+    global _pool_contas
+    if _pool_contas is None:
+        _pool_contas = ProcessPoolExecutor(max_workers=MAX_PROCESSOS_CONTAS)
+    return _pool_contas
+
+# Contas escaneadas vão para um pool próprio e pequeno, para o OCR não ocupar os processos do parse normal
+MAX_PROCESSOS_OCR = 2
+_pool_ocr = None
+
+def obter_pool_ocr() -> ProcessPoolExecutor:
+    global _pool_ocr
+    if _pool_ocr is None:
+        _pool_ocr = ProcessPoolExecutor(max_workers=MAX_PROCESSOS_OCR)
+    return _pool_ocr
+
+def backend_da_conta(caminho: str):
+    """Contas escaneadas: só os retângulos do layout passam pelo OCR. Decidido uma vez, no processo pai."""
+    return "ocr" if primeira_pagina_sem_texto(caminho) else None
+
+def pool_da_conta(backend: str, paralelo: bool):
+    """Pool onde a conta deve rodar; None = no próprio processo."""
+    if backend == "ocr":
+        return obter_pool_ocr()
+    return obter_pool_contas() if paralelo else None
+
+def remover_partes(save_path: str, partes: list):
+    for _, caminho, _ in partes:
+        if caminho != save_path and os.path.exists(caminho):
+            os.remove(caminho)
+
+def processar_pdf(save_path: str, paralelo: bool = True) -> list:
+    """
+    Processa um PDF enviado, que pode conter várias contas.
+    Retorna [(instalacao, paginas, tipo_detectado, linha, erro)], uma entrada por conta.
+    """
+    partes = separar_contas(save_path)
+    try:
+        futuros = {}
+        backends = [backend_da_conta(caminho) for _, caminho, _ in partes]
+        for i, (_, caminho, _) in enumerate(partes):
+            pool = pool_da_conta(backends[i], paralelo and len(partes) > 1)
+            if pool is not None:
+                futuros[i] = pool.submit(_processar_conta_isolada, caminho, backends[i])
+        resultados = [
+            futuros[i].result() if i in futuros else _processar_conta_isolada(caminho, backends[i])
+            for i, (_, caminho, _) in enumerate(partes)
+        ]
+    finally:
+        remover_partes(save_path, partes)
+
+    return [(inst, paginas) + res for (inst, _, paginas), res in zip(partes, resultados)]
+
+# ——— EXTRAÇÃO EM LOTE SEM PLANILHA (/extract) ———
+# Resultados por arquivo, em memória, chaveados pelo sha256 do PDF + impressão dos layouts
+MAX_CACHE_EXTRACAO = 2000
+_cache_extracao = OrderedDict()
+_cache_extracao_lock = threading.Lock()
+
+def _extrair_conta_cronometrada(caminho: str, backend: str = None) -> dict:
+    # Executado nos processos do pool
+    inicio = time.perf_counter()
+    try:
+        tipo = detectar_tipo_conta_inicial(caminho)
+        classificado = time.perf_counter()
+        tipo, linha = processar_conta(caminho, tipo, backend)
+        fim = time.perf_counter()
+        return {
+            "tipo": tipo,
+            "campos": dict(zip(headers, linha)),
+            "tempos_ms": {"classificacao": round((classificado - inicio) * 1000, 1),
+                          "extracao": round((fim - classificado) * 1000, 1)},
+        }
+    except Exception as e:
+        return {"tipo": None, "erro": str(e),
+                "tempos_ms": {"total": round((time.perf_counter() - inicio) * 1000, 1)}}
+
+def _chave_layouts() -> str:
+    return impressao_layout("B3") + impressao_layout("A4_VERDE")
+
+def _ler_cache_extracao(chave: str):
+    with _cache_extracao_lock:
+        if chave in _cache_extracao:
+            _cache_extracao.move_to_end(chave)
+            return _cache_extracao[chave]
+    return None
+
+def _gravar_cache_extracao(chave: str, contas: list):
+    with _cache_extracao_lock:
+        _cache_extracao[chave] = contas
+        _cache_extracao.move_to_end(chave)
+        while len(_cache_extracao) > MAX_CACHE_EXTRACAO:
+            _cache_extracao.popitem(last=False)
+
+def _gerar_ndjson(arquivos: list, pasta, usuario: str):
+    """
+    Emite uma linha JSON por conta assim que ela termina. `arquivos` é [(nome, caminho, chave)];
+    arquivos já em cache saem na hora, os demais são separados em contas e extraídos pelo agendador,
+    na fila de `usuario` e com a mesma prioridade por número de contas dos uploads.
+    O mesmo PDF enviado mais de uma vez na requisição é extraído uma vez só e sai para cada cópia.
+    """
+    try:
+        pendentes = {}   # future → (nome, chave, índice da conta, instalação, páginas)
+        parciais = {}    # chave → [resultado por conta], para gravar no cache quando completar
+        copias = {}      # chave → nomes das outras cópias do mesmo PDF
+        falhas = {}      # chave → erro ao separar o PDF
+        a_extrair = []   # (nome, chave, partes)
+        for nome, caminho, chave in arquivos:
+            em_cache = _ler_cache_extracao(chave)
+            if em_cache is not None:
+                for conta in em_cache:
+                    yield json.dumps(dict(conta, arquivo=nome, cache=True), ensure_ascii=False) + "\n"
+                continue
+            if chave in falhas:
+                yield json.dumps({"arquivo": nome, "tipo": None, "erro": falhas[chave]}, ensure_ascii=False) + "\n"
+                continue
+            if chave in parciais:
+                copias.setdefault(chave, []).append(nome)
+                continue
+            try:
+                partes = separar_contas(caminho)
+            except Exception as e:
+                falhas[chave] = str(e)
+                yield json.dumps({"arquivo": nome, "tipo": None, "erro": str(e)}, ensure_ascii=False) + "\n"
+                continue
+            parciais[chave] = [None] * len(partes)
+            a_extrair.append((nome, chave, partes))
+
+        total_contas = sum(len(partes) for _, _, partes in a_extrair)
+        prioridade = PRIORIDADE_ALTA if total_contas <= LIMITE_CONTAS_PEQUENO else PRIORIDADE_NORMAL
+        for nome, chave, partes in a_extrair:
+            for i, (instalacao, parte, paginas) in enumerate(partes):
+                futuro = agendador.submeter(usuario, _conta_agendada, _extrair_conta_cronometrada, parte, usuario,
+                                            prioridade, prioridade=prioridade)
+                pendentes[futuro] = (nome, chave, i, instalacao, [p + 1 for p in paginas])
+
+        for futuro in as_completed(pendentes):
+            nome, chave, i, instalacao, paginas = pendentes[futuro]
+            conta = dict(futuro.result(), instalacao=instalacao, paginas=paginas, sha256=chave[:64])
+            parciais[chave][i] = conta
+            yield json.dumps(dict(conta, arquivo=nome, cache=False), ensure_ascii=False) + "\n"
+            if all(c is not None for c in parciais[chave]):
+                if not any("erro" in c for c in parciais[chave]):
+                    _gravar_cache_extracao(chave, parciais[chave])
+                for copia in copias.pop(chave, []):
+                    for c in parciais[chave]:
+                        yield json.dumps(dict(c, arquivo=copia, cache=False), ensure_ascii=False) + "\n"
+    finally:
+        pasta.cleanup()
+
+@app.route('/extract', methods=['POST'])
+def extract():
+    """
+    Recebe vários PDFs no campo 'pdfs' e devolve NDJSON (um objeto por conta, com header → valor,
+    tipo detectado e tempos), sem gravar na planilha. Suporta If-None-Match com o ETag devolvido.
+    """
+    arquivos = [f for f in request.files.getlist('pdfs') if f.filename]
+    if not arquivos:
+        return jsonify({"erro": "Nenhum arquivo foi enviado no campo 'pdfs'."}), 400
+
+    pasta = tempfile.TemporaryDirectory(prefix="extract_", dir=app.config['UPLOAD_FOLDER'])
+    layouts = _chave_layouts()
+    salvos = []
+    for n, pdf_file in enumerate(arquivos):
+        caminho = os.path.join(pasta.name, f"{n:04d}.pdf")
+        pdf_file.save(caminho)
+        salvos.append((pdf_file.filename, caminho, hash_conteudo(caminho) + layouts))
+
+    etag = hashlib.sha1("".join(c for _, _, c in salvos).encode("ascii")).hexdigest()
+    if etag in request.if_none_match:
+        pasta.cleanup()
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
+
+    resposta = Response(_gerar_ndjson(salvos, pasta, identificar_usuario()), mimetype="application/x-ndjson")
+    resposta.set_etag(etag)
+    return resposta
+
+# ——— PERFIL SOB DEMANDA ———
+# extrair_na_bbox registra cada chamada em _perfil_local.chamadas_bbox quando há perfil ativo
+# na thread; fora disso o custo é um getattr por chamada.
+_perfil_local = threading.local()
+# O cProfile só admite um perfilador ativo por vez no processo
+_perfil_lock = threading.Lock()
+
+def perfil_solicitado() -> bool:
+    return PERFIL_HABILITADO and (request.headers.get("X-Perfil") == "1" or request.args.get("perfil") == "1")
+
+def processar_pdf_com_perfil(save_path: str, nome_arquivo: str) -> list:
+    """
+    Igual a processar_pdf, mas em série e sob cProfile. Grava <base>.prof (pstats) e <base>.json
+    (tipo detectado, duração e cada chamada de extrair_na_bbox) em PERFIL_DIR.
+    """
+    if not _perfil_lock.acquire(blocking=False):
+        print(f"[PERFIL] outro perfil em andamento; {nome_arquivo} processado sem perfil")
+        return processar_pdf(save_path)
+
+    perfil = cProfile.Profile()
+    _perfil_local.chamadas_bbox = []
+    inicio = time.perf_counter()
+    try:
+        perfil.enable()
+        try:
+            contas = processar_pdf(save_path, paralelo=False)
+        finally:
+            perfil.disable()
+    finally:
+        chamadas = _perfil_local.chamadas_bbox
+        _perfil_local.chamadas_bbox = None
+        _perfil_lock.release()
+    duracao = time.perf_counter() - inicio
+
+    # '-' sobrevive ao secure_filename de /perfis/<nome>; '+' seria removido e o perfil daria 404
+    tipos = "-".join(sorted({tipo or "ERRO" for _, _, tipo, _, _ in contas}))
+    base = f"{datetime.now():%Y%m%d-%H%M%S-%f}_{secure_filename(os.path.splitext(nome_arquivo)[0])}_{tipos}"
+    os.makedirs(PERFIL_DIR, exist_ok=True)
+    perfil.dump_stats(os.path.join(PERFIL_DIR, base + ".prof"))
+    with open(os.path.join(PERFIL_DIR, base + ".json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "perfil": base,
+            "arquivo": nome_arquivo,
+            "tipo": tipos,
+            "contas": len(contas),
+            "duracao_s": round(duracao, 4),
+            "chamadas_bbox": chamadas,
+        }, f, ensure_ascii=False)
+    print(f"[PERFIL] {nome_arquivo} ({tipos}) em {duracao:.3f}s → {base}.prof")
+    return contas
+
+@app.route('/perfis')
+def listar_perfis():
+    if not PERFIL_HABILITADO:
+        abort(404)
+    perfis = []
+    if os.path.isdir(PERFIL_DIR):
+        for nome in sorted(os.listdir(PERFIL_DIR), reverse=True):
+            if nome.endswith(".json"):
+                with open(os.path.join(PERFIL_DIR, nome), encoding="utf-8") as f:
+                    meta = json.load(f)
+                meta["chamadas_bbox"] = len(meta.get("chamadas_bbox", []))
+                perfis.append(meta)
+    return jsonify(perfis)
+
+@app.route('/perfis/<nome>')
+def ver_perfil(nome):
+    """Resumo em texto (top funções por tempo acumulado e bboxes mais lentas); ?formato=prof baixa o pstats."""
+    if not PERFIL_HABILITADO:
+        abort(404)
+    nome = secure_filename(nome)
+    caminho = os.path.join(PERFIL_DIR, nome + ".prof")
+    if not os.path.exists(caminho):
+        abort(404)
+    if request.args.get("formato") == "prof":
+        return send_from_directory(os.path.abspath(PERFIL_DIR), nome + ".prof", as_attachment=True)
+
+    saida = io.StringIO()
+    stats = pstats.Stats(caminho, stream=saida)
+    stats.sort_stats("cumulative").print_stats(40)
+    stats.print_callers("re.py.*(search|match|findall|sub)|extrair_na_bbox")
+    with open(os.path.join(PERFIL_DIR, nome + ".json"), encoding="utf-8") as f:
+        chamadas = json.load(f).get("chamadas_bbox", [])
+    saida.write("\nChamadas de extrair_na_bbox (mais lentas primeiro):\n")
+    for c in sorted(chamadas, key=lambda c: c["ms"], reverse=True):
+        saida.write(f"{c['ms']:>10.3f} ms  bbox={tuple(c['bbox'])} → '{c['texto']}'\n")
+    return saida.getvalue(), 200, {"Content-Type": "text/plain; charset=utf-8"}
+
+# ——— GRAVAÇÃO NAS PLANILHAS DE DESTINO ———
+def gravar_linhas(linhas: list, formulario: dict) -> dict:
+    """
+    Distribui as linhas (na ordem de `headers`) entre os destinos de REGRAS_DESTINO e grava
+    um append por destino. Retorna {"planilha/aba": quantidade}.
+    """
+    por_destino = {}
+    for linha in linhas:
+        dados = dict(zip(headers, linha))
+        destino = escolher_destino(REGRAS_DESTINO, dados, formulario, DESTINO_PADRAO)
+        por_destino.setdefault(destino, []).append(dados)
+
+    gravadas = {}
+    for destino, lista in por_destino.items():
+        aba, headers_destino = planilhas.obter(*destino)
+        linhas_destino = [reordenar_linha(d, headers_destino) for d in lista]
+        if len(linhas_destino) == 1:
+            aba.append_row(linhas_destino[0])
+        else:
+            aba.append_rows(linhas_destino)
+        gravadas[f"{aba.spreadsheet.title}/{aba.title}"] = len(linhas_destino)
+    return gravadas
+
+# ——— HISTÓRICO POR INSTALAÇÃO ———
+def registrar_historico(linhas: list):
+    if not HISTORICO_DB or not linhas:
+        return
+    try:
+        historico.registrar_linhas(HISTORICO_DB, headers, linhas)
+    except Exception as e:
+        print(f"[ERRO] ao atualizar histórico: {e}")
+
+@app.route('/historico/agregados')
+def historico_agregados():
+    if not HISTORICO_DB:
+        abort(404)
+    return jsonify(historico.agregados_mensais(
+        HISTORICO_DB,
+        de=request.args.get("de", ""),
+        ate=request.args.get("ate", ""),
+        prefixo_instalacao=request.args.get("prefixo", ""),
+    ))
+
+@app.route('/historico/<instalacao>')
+def historico_instalacao(instalacao):
+    """Série mensal da instalação; ?campos=a,b acrescenta outras colunas da linha gravada."""
+    if not HISTORICO_DB:
+        abort(404)
+    meses = request.args.get("meses", 24, type=int)
+    campos = [c for c in request.args.get("campos", "").split(",") if c]
+    return jsonify({
+        "instalacao": instalacao,
+        "serie": historico.serie_instalacao(HISTORICO_DB, instalacao, meses, campos),
+    })
+
+# ——— AGENDAMENTO JUSTO DOS UPLOADS ———
+# Cada conta de cada PDF enviado (upload ou /extract) vira uma tarefa na fila do usuário que enviou.
+# A tarefa ocupa um único processo do pool por vez, então max_por_usuario, pesos e rodízio valem por
+# conta: um PDF consolidado com centenas de instalações não enche o pool na frente dos outros.
+# Uploads com até LIMITE_CONTAS_PEQUENO contas (somando todos os arquivos) passam na frente dos lotes.
+AGENDADOR_MAX_SIMULTANEOS = MAX_PROCESSOS_CONTAS
+AGENDADOR_MAX_POR_USUARIO = max(1, MAX_PROCESSOS_CONTAS // 2)
+LIMITE_CONTAS_PEQUENO = 3
+PESOS_USUARIO = {}   # ex.: {"financeiro": 2} despacha 2 tarefas por vez no rodízio
+
+agendador = Agendador(AGENDADOR_MAX_SIMULTANEOS, AGENDADOR_MAX_POR_USUARIO, PESOS_USUARIO)
+# Contas escaneadas têm fila própria, do tamanho do pool de OCR: um OCR demorado não segura vagas
+# do parse de texto, e o rodízio entre usuários vale também para o OCR.
+agendador_ocr = Agendador(MAX_PROCESSOS_OCR, max(1, MAX_PROCESSOS_OCR // 2), PESOS_USUARIO)
+
+def identificar_usuario() -> str:
+    return (request.form.get("usuario") or request.headers.get("X-Usuario") or request.remote_addr or "anonimo").strip()
+
+def _no_pool(pool, tarefa, caminho: str, backend: str):
+    # Roda numa thread do agendador, que só espera o processo do pool terminar a conta
+    return pool.submit(tarefa, caminho, backend).result()
+
+def _conta_agendada(tarefa, caminho: str, usuario: str, prioridade: int):
+    """
+    Tarefa do agendador para uma conta: `tarefa(caminho, backend)` roda no pool de processos.
+    Contas escaneadas são repassadas ao agendador_ocr; o Future devolvido libera a vaga na hora.
+    """
+    backend = backend_da_conta(caminho)
+    if backend == "ocr":
+        return agendador_ocr.submeter(usuario, _no_pool, obter_pool_ocr(), tarefa, caminho, backend,
+                                      prioridade=prioridade)
+    return _no_pool(obter_pool_contas(), tarefa, caminho, backend)
+
+def gravar_upload(nome_arquivo: str, contas: list, formulario: dict) -> list:
+    """Grava as contas extraídas de um PDF enviado; devolve as mensagens para a página."""
+    mensagens = []
+    linhas = []
+    for instalacao, paginas, tipo_detectado, linha, erro in contas:
+        nome = nome_arquivo
+        if len(contas) > 1:
+            nome += f" [inst. {instalacao or '?'}, pág. {paginas[0] + 1}-{paginas[-1] + 1}]"
+        if erro:
+            mensagens.append(f"[ERRO] {nome}: {erro}")
+            continue
+        linhas.append(linha)
+        mensagens.append(f"[OK] {nome} ({tipo_detectado}) processado com sucesso.")
+
+    if linhas:
+        gravadas = gravar_linhas(linhas, formulario)
+        if REGRAS_DESTINO:
+            for destino, n in gravadas.items():
+                mensagens.append(f"[OK] {nome_arquivo}: {n} linha(s) → {destino}")
+    registrar_historico(linhas)
+    return mensagens
+
+@app.route('/fila')
+def situacao_fila():
+    return jsonify(dict(agendador.situacao(), ocr=agendador_ocr.situacao()))
+
 # ———ROTA FLASK COM SUPORTE A B3 E A4 VERDE ———
 @app.route('/', methods=['GET', 'POST'])
 def index():
@@ -568,46 +1228,66 @@ def index():
             msg = "Nenhum arquivo foi selecionado."
             return render_template('index.html', msg=msg)
 
+        com_perfil = perfil_solicitado()
+        usuario = identificar_usuario()
+        formulario = request.form.to_dict()
+
+        # (nome, caminho salvo, partes, erro) na ordem do envio; partes None = upload com perfil
+        enviados = []
         for pdf_file in arquivos:
-            if not pdf_file.filename.endswith(".pdf"):
-                mensagens.append(f"[ERRO] {pdf_file.filename}: Arquivo não é PDF.")
+            nome = pdf_file.filename
+            if not nome.endswith(".pdf"):
+                enviados.append((nome, None, None, "Arquivo não é PDF."))
                 continue
 
-            save_path = os.path.join(app.config['UPLOAD_FOLDER'], pdf_file.filename)
+            # Nome único: uploads simultâneos podem trazer arquivos com o mesmo nome
+            save_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{uuid.uuid4().hex}_{secure_filename(nome)}")
             pdf_file.save(save_path)
-
+            partes = None
+            if not com_perfil:
+                try:
+                    partes = separar_contas(save_path)
+                except Exception as e:
+                    os.remove(save_path)
+                    enviados.append((nome, None, None, str(e)))
+                    continue
+            enviados.append((nome, save_path, partes, None))
+
+        # Prioridade pelo número de contas, já separadas; uploads com perfil rodam em série como lote
+        total_contas = sum(len(partes) for _, _, partes, _ in enviados if partes)
+        pequeno = not com_perfil and total_contas <= LIMITE_CONTAS_PEQUENO
+        prioridade = PRIORIDADE_ALTA if pequeno else PRIORIDADE_NORMAL
+
+        tarefas = []
+        for nome, save_path, partes, erro in enviados:
+            if erro:
+                tarefas.append(None)
+            elif partes is None:
+                tarefas.append(agendador.submeter(
+                    usuario, processar_pdf_com_perfil, save_path, nome, prioridade=prioridade,
+                ))
+            else:
+                tarefas.append([
+                    agendador.submeter(usuario, _conta_agendada, _processar_conta_isolada, caminho, usuario, prioridade,
+                                       prioridade=prioridade)
+                    for _, caminho, _ in partes
+                ])
+
+        for (nome, save_path, partes, erro), tarefa in zip(enviados, tarefas):
+            if erro:
+                mensagens.append(f"[ERRO] {nome}: {erro}")
+                continue
             try:
-                tipo_detectado = detectar_tipo_conta_inicial(save_path)
-
-                if tipo_detectado == "B3":
-                    linha = extrair_por_regras(save_path)
-                    tarifa_cod = "3"
-                    subgrupo_cod = "6"
-                elif tipo_detectado == "A4_VERDE":
-                    linha = extrair_por_regras_a4_verde(save_path)
-                    tarifa_cod = "1"
-                    subgrupo_cod = "5"
-                elif tipo_detectado == "THS_VERDE_A4":
-                    linha = extrair_por_regras_ths_verde_a4(save_path)
-                    tarifa_cod = "2"
-                    subgrupo_cod = "7"
+                if partes is None:
+                    contas = tarefa.result()
                 else:
-                    mensagens.append(f"[ERRO] {pdf_file.filename}: Tipo de conta não suportado.")
-                    continue
-
-                # Atualiza os campos se existirem no header
-                if "cadTarifaCod" in headers:
-                    idx_tarifa = headers.index("cadTarifaCod")
-                    linha[idx_tarifa] = tarifa_cod
-                if "cadSubGrupoCod" in headers:
-                    idx_subgrupo = headers.index("cadSubGrupoCod")
-                    linha[idx_subgrupo] = subgrupo_cod
-
-                worksheet.append_row(linha)
-                mensagens.append(f"[OK] {pdf_file.filename} ({tipo_detectado}) processado com sucesso.")
+                    contas = [(inst, paginas) + t.result() for (inst, _, paginas), t in zip(partes, tarefa)]
+                mensagens.extend(gravar_upload(nome, contas, formulario))
             except Exception as e:
-                mensagens.append(f"[ERRO] {pdf_file.filename}: {str(e)}")
+                mensagens.append(f"[ERRO] {nome}: {str(e)}")
             finally:
+                if partes:
+                    remover_partes(save_path, partes)
                 os.remove(save_path)
 
         msg = "\n".join(mensagens)
@@ -617,4 +1297,18 @@ def index():
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--comparar-backends":
+        divergencias = comparar_backends(sys.argv[3:], sys.argv[2])
+        sys.exit(1 if divergencias else 0)
+    if len(sys.argv) > 1 and sys.argv[1] == "--importar-historico":
+        if not HISTORICO_DB:
+            sys.exit("Defina HISTORICO_DB para importar o histórico.")
+        valores = worksheet.get_all_values()
+        total = historico.registrar_linhas(HISTORICO_DB, valores[0], valores[1:])
+        print(f"[HISTÓRICO] {total} de {len(valores) - 1} linha(s) importada(s) para {HISTORICO_DB}")
+        sys.exit(0)
+    if len(sys.argv) > 2 and sys.argv[1] == "--reextrair":
+        args = [a for a in sys.argv[2:] if a != "--gravar"]
+        reextrair_cache(args[0], args[1] if len(args) > 1 else None, gravar="--gravar" in sys.argv)
+        sys.exit(0)
     app.run(debug=True)